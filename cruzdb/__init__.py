@@ -9,6 +9,9 @@ if sys.version_info[0] >= 3:
     from past.builtins import long
 import os
 import re
+from collections import namedtuple
+from operator import itemgetter
+from sqlalchemy import and_, or_, func, select, bindparam
 from sqlalchemy.orm.query import Query
 
 import pymysql
@@ -19,11 +22,215 @@ __version__ = "0.5.6"
 class BigException(Exception): pass
 
 from .tests import test
+from .cache import TileCache, LocalTileCache, CachedRows, TILE_SHIFT, \
+        MAX_TILES
+from .columnar import ColumnarGenome
 
 def _open(filelike, mode='r'):
     if hasattr(filelike, 'read'): return filelike
     return open(filelike, mode)
 
+def _nearest_query(q, col, skip, descending=False):
+    """
+    return a query for the rows of `q` with the `skip` + 1 smallest (or
+    largest if `descending`) values of `col` along with any rows that tie
+    the last of those. This is a single statement so the database can walk
+    the index on `col`. `skip` can be a bindparam.
+    """
+    order = col.desc() if descending else col
+    kth = q.with_entities(col).order_by(order).offset(skip).limit(1).as_scalar()
+    # when there are fewer than k rows, kth is NULL and everything is kept.
+    if descending:
+        return q.filter(col >= func.coalesce(kth, col))
+    return q.filter(col <= func.coalesce(kth, col))
+
+def _nearest_scan(q, col, k, descending=False):
+    """
+    return the rows of `q` with the k smallest (or largest if `descending`)
+    values of `col` along with any rows that tie the kth value.
+    """
+    return _nearest_query(q, col, k - 1, descending).all()
+
+# used by bin_query_many to match returned rows to the query regions.
+_Region = namedtuple('_Region', 'chrom start end index')
+
+def _start_end_columns(tbl):
+    """
+    return the (start, end) columns of a UCSC table which uses either
+    txStart/txEnd or chromStart/chromEnd
+    """
+    if hasattr(tbl.c, "txStart"):
+        return tbl.c.txStart, tbl.c.txEnd
+    return tbl.c.chromStart, tbl.c.chromEnd
+
+# bin_query uses the bin column only when there are fewer bins than this.
+MAX_BINS = 100
+
+# (offset, shift) of each level of the UCSC binning scheme from the 128kb
+# bins up to bin 0 which covers 512Mb.
+_BIN_LEVELS = ((585, 17), (73, 20), (9, 23), (1, 26), (0, 29))
+
+def _bin_ranges(start, end):
+    """
+    return the (first, last) bin at each level of the UCSC binning scheme
+    that a feature overlapping `start`, `end` can be in. These are the bins
+    from `Genome.bins` (along with bin 0) as one range per level so the
+    filter can be a few BETWEENs rather than a long IN list.
+    """
+    if end - start >= 536870912:
+        raise BigException
+    return [(offset + (start >> shift), offset + ((end - 1) >> shift))
+            for offset, shift in _BIN_LEVELS]
+
+def _use_bins(tbl, start, end):
+    """
+    return the bin ranges for a query of `tbl` or None if it has no bin
+    column or the query covers so many bins that the filter isn't worth it.
+    """
+    if not hasattr(tbl.c, "bin"):
+        return None
+    ranges = _bin_ranges(start, end)
+    if sum(last - first + 1 for first, last in ranges) >= MAX_BINS:
+        return None
+    return ranges
+
+def _bin_clause(tbl, chrom, start, end, plan=None):
+    """
+    where clause for the rows of `tbl` on `chrom` that overlap `start`, `end`
+    using the bin column if there is one. `plan(tbl, chrom, start, end)`
+    (see `Genome._plan`) can return (None, lowest) instead of the bin ranges
+    to bound the starts to (lowest, end) so an index on the start can be
+    used.
+    """
+    cstart, cend = _start_end_columns(tbl)
+    if plan is None:
+        ranges, lowest = _use_bins(tbl, start, end), None
+    else:
+        ranges, lowest = plan(tbl, chrom, start, end)
+    if ranges is not None:
+        # chrom is repeated in each range so every one is an index lookup.
+        clause = or_(*[and_(tbl.c.chrom == chrom, tbl.c.bin.between(*r))
+                       for r in ranges])
+    elif lowest is not None:
+        clause = and_(tbl.c.chrom == chrom, cstart >= lowest)
+    else:
+        clause = tbl.c.chrom == chrom
+    return and_(clause, cstart <= end, cend >= start)
+
+def _spatial_clause(tbl, binned):
+    """
+    the same where clause as `_bin_clause` but with bound parameters
+    (chrom, start, end and either the bin ranges if `binned` or the lowest
+    start) so that the statement can be compiled once and reused for any
+    region. See `_spatial_params`.
+    """
+    cstart, cend = _start_end_columns(tbl)
+    chrom = tbl.c.chrom == bindparam("chrom")
+    if binned:
+        clause = or_(*[and_(chrom, tbl.c.bin.between(bindparam("first%i" % i),
+                                                     bindparam("last%i" % i)))
+                       for i in range(len(_BIN_LEVELS))])
+    else:
+        clause = and_(chrom, cstart >= bindparam("lowest"))
+    return and_(clause, cstart <= bindparam("end"), cend >= bindparam("start"))
+
+def _spatial_params(tbl, chrom, start, end, plan):
+    """
+    return (binned, params) for `_spatial_clause` for a query of `tbl`.
+    `plan` is as for `_bin_clause`.
+    """
+    params = dict(chrom=chrom, start=start, end=end)
+    ranges, lowest = plan(tbl, chrom, start, end)
+    if ranges is None:
+        params["lowest"] = lowest
+        return False, params
+    for i, (first, last) in enumerate(ranges):
+        params["first%i" % i], params["last%i" % i] = first, last
+    return True, params
+
+def _projection(tbl, columns, *extra):
+    """
+    return the names of `columns` of `tbl` along with chrom, start, end (so
+    the helpers on rows still work) and any `extra` in the order of the
+    table.
+    """
+    want = set(columns)
+    want.update(extra)
+    if hasattr(tbl.c, "chrom"):
+        want.add("chrom")
+    if hasattr(tbl.c, "txStart") or hasattr(tbl.c, "chromStart"):
+        want.update(c.name for c in _start_end_columns(tbl))
+    missing = want.difference(tbl.c.keys())
+    if missing:
+        raise ValueError("%s has no column(s) %s" % (tbl.name,
+                                                     ", ".join(sorted(missing))))
+    return [c.name for c in tbl.columns if c.name in want]
+
+def _keyset_columns(tbl):
+    """
+    return (columns, unique) for the primary key or a unique index of `tbl`
+    or else for the index with the most columns. These are used to page
+    through the table. Returns (None, False) if there is no index.
+    """
+    if len(tbl.primary_key.columns):
+        return list(tbl.primary_key.columns), True
+    indexes = sorted(tbl.indexes, key=lambda i: (not i.unique,
+                                                 -len(i.columns), i.name))
+    if not indexes:
+        return None, False
+    return list(indexes[0].columns), indexes[0].unique
+
+def _after(key, values):
+    """
+    rows with a `key` after `values`: (a > x) or (a = x and b > y) ...
+    this is written out rather than as a row-value comparison so that the
+    databases that don't support those (or use the index for them) work.
+    """
+    return or_(*[and_(*[c == v for c, v in zip(key[:i], values[:i])] +
+                       [key[i] > values[i]]) for i in range(len(key))])
+
+def _stream_query(q, tbl, chunk=8000):
+    """
+    yield the rows of query `q` on `tbl` using keyset pagination: each page
+    is ordered by an index (see _keyset_columns) and starts after the key
+    of the last row of the previous page. Unlike LIMIT/OFFSET, the database
+    does not rescan the skipped rows for each page. If the key isn't unique,
+    the rows with the last key of a page are read together. Those, the rows
+    with a NULL in the key (read at the end) and all rows if `tbl` has no
+    index are read with a server-side cursor so at most `chunk` rows are
+    held at a time.
+    """
+    streamed = lambda q: q.execution_options(stream_results=True
+                                             ).yield_per(chunk)
+    key, unique = _keyset_columns(tbl)
+    if key is None:
+        for row in streamed(q):
+            yield row
+        return
+
+    names = [c.name for c in key]
+    keyof = lambda row: tuple(getattr(row, n) for n in names)
+    base = q.filter(and_(*[c.isnot(None) for c in key])).order_by(*key)
+    last = None
+    while True:
+        page = base if last is None else base.filter(_after(key, last))
+        rows = page.limit(chunk).all()
+        if not rows: break
+        last = keyof(rows[-1])
+        if unique or len(rows) < chunk:
+            for row in rows: yield row
+            if len(rows) < chunk: break
+            continue
+        for row in rows:
+            # the page may end part way through the rows with the last key.
+            if keyof(row) == last: break
+            yield row
+        for row in streamed(base.filter(and_(*[c == v for c, v in
+                                               zip(key, last)]))):
+            yield row
+    for row in streamed(q.filter(or_(*[c.is_(None) for c in key]))):
+        yield row
+
 class Genome(soup.Genome):
     """
     Connect to a particular database
@@ -57,16 +264,50 @@ class Genome(soup.Genome):
         if specified, all other parameters must be unused. just forces
             use of an existing engine
 
+    tile_cache : int or cruzdb.cache.TileCache
+        if specified, `bin_query` and `knearest` on tables (by name) fetch
+        whole 128kb tiles and keep them in an LRU cache of at most this many
+        rows. Use this when many queries are near each other. The hits and
+        misses are counted on `Genome.tile_cache`.
+
+    cache : str
+        dburl of a local database, e.g. "sqlite:///cache.db". If specified,
+        `bin_query` and `knearest` on tables (by name) copy each 128kb tile
+        they use into this database and later queries (also in later
+        sessions) on those tiles are answered from it. See
+        `cruzdb.cache.LocalTileCache`. `tile_cache` then sets the size of
+        the in-memory cache in front of it.
+
+    defer_blobs : bool
+        if True, blob columns (e.g. exonStarts and exonEnds) of mapped
+        tables are not loaded with the rest of each row, but only when they
+        are accessed. Also see the `columns` argument to `bin_query`.
+
     """
     url = "mysql+{dialect}://{user}{password}@{host}/{db}"
     db_regex = re.compile(r"^(sqlite|mysql|postgresql)(.+[^:]+){0,1}://")
 
     def __init__(self, db="", user="genome", host="genome-mysql.cse.ucsc.edu",
-            password="", dialect="mysqldb", engine=None):
+            password="", dialect="mysqldb", engine=None, tile_cache=None,
+            cache=None, defer_blobs=False):
 
+        from sqlalchemy.ext import baked
+        self.defer_blobs = defer_blobs
         self.create_url(db, user, host, password, dialect)
         soup.Genome.__init__(self, self.dburl)
         self.session.autoflush = False
+        # built and compiled statements for the spatial queries.
+        self._bakery = baked.bakery()
+        self._statements = {}
+        self._max_lengths = {}
+        # TableStats by table name; read from the database when first used.
+        self._table_stats = None
+        if cache is not None:
+            tile_cache = TileCache(tile_cache or 500000,
+                                   backing=LocalTileCache(self, cache))
+        elif tile_cache is not None and not isinstance(tile_cache, TileCache):
+            tile_cache = TileCache(tile_cache)
+        self.tile_cache = tile_cache
 
     def create_url(self, db="", user="genome", host="genome-mysql.cse.ucsc.edu",
         password="", dialect="mysqldb"):
@@ -93,11 +334,13 @@ class Genome(soup.Genome):
             self.dburl = self.url.format(db=self.db, user=self.user,
                 host=self.host, password=self.password, dialect=dialect)
 
-    def mirror(self, tables, dest_url):
+    def mirror(self, tables, dest_url, threads=4, regions=None):
         """
         miror a set of `tables` from `dest_url`
 
-        Returns a new Genome object
+        Returns a new Genome object. Tables are bulk-loaded without indexes
+        (with fast, unsafe pragmas for a new sqlite destination); the indexes
+        are built and the tables analyzed once the rows are loaded.
 
         Parameters
         ----------
@@ -105,11 +348,54 @@ class Genome(soup.Genome):
         tables : list
             an iterable of tables
 
+        dest_url: str
+            a dburl string, e.g. 'sqlite:///local.db' or
+            'columnar:///path/to/dir' to write the tables as NumPy arrays
+            that can be queried with `cruzdb.ColumnarGenome`.
+
+        threads : int
+            number of chromosome partitions to copy at once. Each partition
+            is verified with a checksum and recorded in `dest_url` so that
+            an interrupted mirror can be run again to copy the rest.
+
+        regions : list
+            copy only the rows in these chromosomes (e.g. ["chr21"]) or
+            (chrom, start, end) regions along with the chromInfo rows and
+            the kgXref (and similar) rows for the copied features.
+        """
+        from .mirror import mirror
+        return mirror(self, tables, dest_url, threads=threads,
+                      regions=regions)
+
+    @staticmethod
+    def load_ucsc_dump(schema_path, data_path, dest_url, processes=None):
+        """
+        load a table from the files that UCSC publishes for each table
+        (e.g. refGene.sql and refGene.txt.gz) into `dest_url` without a
+        connection to UCSC. An existing table of the same name is replaced.
+
+        Returns a new Genome object
+
+        Parameters
+        ----------
+
+        schema_path : str
+            the .sql file with the CREATE TABLE statement for the table.
+            mysql-specific types are converted as in `mirror`.
+
+        data_path : str
+            the tab-delimited rows (.txt.gz or .txt)
+
         dest_url: str
             a dburl string, e.g. 'sqlite:///local.db'
+
+        processes : int
+            number of processes that parse the rows (default: number of
+            CPUs). The file is decompressed in another process.
         """
-        from mirror import mirror
-        return mirror(self, tables, dest_url)
+        from .mirror import load_dump
+        return load_dump(schema_path, data_path, dest_url,
+                         processes=processes)
 
     def dataframe(self, table):
         """
@@ -179,38 +465,51 @@ class Genome(soup.Genome):
         from pandas.io import sql
         import pandas as pa
         from toolshed import nopen
+        from .mirror import _Destination
 
-        needs_name = False
-        for i, chunk in enumerate(pa.read_csv(nopen(fname), iterator=True,
-            chunksize=100000, sep=sep, encoding="latin-1")):
-            chunk.columns = [convs.get(k, k) for k in chunk.columns]
-            if not "name" in chunk.columns:
-                needs_name = True
-                chunk['name'] = chunk.get('chrom', chunk[chunk.columns[0]])
-            if bins:
-                chunk['bin'] = 1
-            if i == 0 and not table in self.tables:
-                flavor = self.url.split(":")[0]
-                schema = sql.get_schema(chunk, table, flavor)
-                print(schema)
-                self.engine.execute(schema)
-            elif i == 0:
-                print >>sys.stderr,\
-                        """adding to existing table, you may want to drop first"""
-
-            tbl = getattr(self, table)._table
-            cols = chunk.columns
-            data = list(dict(zip(cols, x)) for x in chunk.values)
-            if needs_name:
-                for d in data:
-                    d['name'] = "%s:%s" % (d.get("chrom"), d.get("txStart", d.get("chromStart")))
-            if bins:
-                for d in data:
-                    d['bin'] = max(Genome.bins(int(d["txStart"]), int(d["txEnd"])))
-            self.engine.execute(tbl.insert(), data)
-            self.session.commit()
-            if i > 0:
-                print >>sys.stderr, "writing row:", i * 100000
+        dest = None
+        try:
+            for i, chunk in enumerate(pa.read_csv(nopen(fname), iterator=True,
+                chunksize=100000, sep=sep, encoding="latin-1")):
+                chunk.columns = [convs.get(k, k) for k in chunk.columns]
+                if not "name" in chunk.columns:
+                    chunk['name'] = (chunk["chrom"].astype(str) if "chrom"
+                                     in chunk else "None") + ":" + \
+                                    (chunk["txStart"].astype(str) if
+                                     "txStart" in chunk else "None")
+                if bins:
+                    chunk['bin'] = Genome.bins_array(chunk["txStart"].values,
+                                                     chunk["txEnd"].values)
+                if i == 0 and not table in self.tables:
+                    schema = sql.get_schema(chunk, table, con=self.engine)
+                    print(schema)
+                    self.engine.execute(schema)
+                elif i == 0:
+                    print("adding to existing table, you may want to drop first",
+                          file=sys.stderr)
+                if dest is None:
+                    tbl = getattr(self, table)._table
+                    dest = _Destination(self.dburl)
+
+                # tuples in the order of the table's columns with None for
+                # missing values.
+                cols = []
+                for c in tbl.columns:
+                    col = chunk.get(c.name)
+                    if col is None:
+                        cols.append([None] * len(chunk))
+                    elif col.isnull().any():
+                        cols.append(col.astype(object).where(col.notnull(),
+                                                             None).tolist())
+                    else:
+                        cols.append(col.tolist())
+                dest.insert(tbl, list(zip(*cols)))
+                if i > 0:
+                    print("writing row:", i * 100000, file=sys.stderr)
+        finally:
+            if dest is not None:
+                dest.close()
+            self._forget(table)
         if "txStart" in chunk.columns:
             if "chrom" in chunk.columns:
                 ssql = """CREATE INDEX "%s.chrom_txStart" ON "%s" (chrom, txStart)""" % (table, table)
@@ -249,11 +548,20 @@ class Genome(soup.Genome):
         import webbrowser
         webbrowser.open(URL % ",".join(set(refseq_list)) + ",".join(annot))
 
-    def bin_query(self, table, chrom, start, end):
+    def bin_query(self, table, chrom, start, end, raw=False, columns=None):
         """
         perform an efficient spatial query using the bin column if available.
         The possible bins are calculated from the `start` and `end` sent to
-        this function.
+        this function and sent as a range for each level of the binning
+        scheme. Queries that cover too many bins (or tables without a bin
+        column) instead limit the start to within the length of the longest
+        feature on `chrom` of `start`.
+
+        This returns a Query (so it can be filtered further) which is built
+        and compiled for each call. With `raw` (and in `knearest`), the
+        statement is compiled once for each table and the region and its
+        bins are bound as parameters, which is much faster for many small
+        queries.
 
         Parameters
         ----------
@@ -270,6 +578,524 @@ class Genome(soup.Genome):
         end : int
             0-based end position
 
+        raw : bool
+            return read-only records from a Core select rather than mapped
+            objects (see `rows`). The tile cache is not used.
+
+        columns : list
+            names of the columns to load (chrom, start and end are always
+            included). Other columns are deferred on mapped objects (loaded
+            with another query if accessed) and left out of raw records.
+            Rows from the tile cache have all columns.
+        """
+        if raw:
+            return self.rows(table, chrom, start, end, columns=columns)
+        if self._tiled(table, start, end):
+            return CachedRows(self.tile_cache.overlapping(table, chrom,
+                                long(start), long(end),
+                                self._tile_fetcher(table, chrom)))
+        return self._bin_query(table, chrom, start, end, columns)
+
+    def _tiled(self, table, start, end):
+        """internal: whether a query of `table` is answered from tiles"""
+        return self.tile_cache is not None and \
+                isinstance(table, six.string_types) and \
+                (end >> TILE_SHIFT) - (start >> TILE_SHIFT) < MAX_TILES
+
+    def _tile_fetcher(self, table, chrom):
+        """
+        internal: return a function to get the rows of a tile from the
+        database for the tile cache. Rows that end on the first base of a
+        tile are left to the tile before (as the bins do) so a tile holds
+        the same rows whether or not the bins were used to fetch it.
+        """
+        return lambda start, end: [r for r in self._overlapping(table, chrom,
+                                    start, end) if r.end > start or r.start >= start]
+
+    def _bin_query(self, table, chrom, start, end, columns=None):
+        """internal: bin_query without the tile cache"""
+        table, tbl = self._table_for(table, columns)
+        return table.filter(_bin_clause(tbl, chrom, start, end,
+                                        self._plan))
+
+    def _baked(self, table, build, *key):
+        """
+        internal: return a BakedQuery of `build(query, tbl)` on `table` (a
+        name or mapped table) or None if `table` is a query as those can't
+        be cached. The statement is built and compiled the first time for
+        each `build`, table and `key` (which must include anything else that
+        changes the statement); later calls only bind new parameters.
+        """
+        if isinstance(table, Query):
+            return None
+        mapped, tbl = self._table_for(table)
+        return self._bakery(lambda s: build(s.query(mapped), tbl),
+                            build.__code__, tbl.name, *key)
+
+    def _overlapping(self, table, chrom, start, end, columns=None):
+        """
+        internal: the list of mapped rows from `_bin_query` using a cached
+        statement for each table and shape of query.
+        """
+        if isinstance(table, Query):
+            return self._bin_query(table, chrom, start, end, columns).all()
+        tbl = self._table_for(table)[1]
+        binned, params = _spatial_params(tbl, chrom, start, end,
+                                         self._plan)
+
+        def build(q, tbl):
+            if columns is not None:
+                from sqlalchemy.orm import load_only
+                q = q.options(load_only(*_projection(tbl, columns)))
+            return q.filter(_spatial_clause(tbl, binned))
+
+        bq = self._baked(table, build, binned, columns and tuple(columns))
+        return bq(self.session()).params(**params).all()
+
+    def _nearest(self, table, chrom, pos, k, up, columns=None):
+        """
+        internal: the k (plus ties) nearest features on `chrom` that end
+        before (`up`) or start after `pos` using a cached statement.
+        """
+        def build(q, tbl):
+            if columns is not None:
+                from sqlalchemy.orm import load_only
+                q = q.options(load_only(*_projection(tbl, columns)))
+            cstart, cend = _start_end_columns(tbl)
+            q = q.filter(tbl.c.chrom == bindparam("chrom"))
+            if up:
+                return _nearest_query(q.filter(cend < bindparam("pos")), cend,
+                                      bindparam("skip"), descending=True)
+            return _nearest_query(q.filter(cstart > bindparam("pos")), cstart,
+                                  bindparam("skip"))
+
+        bq = self._baked(table, build, up, columns and tuple(columns))
+        if bq is None:
+            table, tbl = self._table_for(table, columns)
+            cstart, cend = _start_end_columns(tbl)
+            q = table.filter(tbl.c.chrom == chrom)
+            if up:
+                return _nearest_scan(q.filter(cend < pos), cend, k,
+                                     descending=True)
+            return _nearest_scan(q.filter(cstart > pos), cstart, k)
+        return bq(self.session()).params(chrom=chrom, pos=pos,
+                                         skip=k - 1).all()
+
+    def _window_nearest(self, table, chrom, start, end, k, direction,
+                        columns=None):
+        """
+        internal: find the k nearest features (and any ties) with overlap
+        queries of a window around `start`, `end` that is sized from the
+        `stats` of the table to hold about 2k features and widened until the
+        kth is inside it. Returns None if there are no stats, if the
+        table has indexes on chrom and the start and end (so the ordered
+        scans in `knearest` are cheaper) or if it isn't found in 4 windows.
+        """
+        tbl = self._table_for(table)[1]
+        st = self._known_stats(tbl)
+        if st is None or not st.rows.get(chrom):
+            return None
+        cstart, cend = _start_end_columns(tbl)
+        if st.has_index("chrom", cstart.name) and \
+                st.has_index("chrom", cend.name):
+            return None
+        # a window of 2w bases overlaps about density * (2w + length)
+        # features so it is sized for 2k of them with the median length.
+        density = st.density(chrom)
+        w = long(max(k / density - st.length_quantile(0.5) / 2.0,
+                     k / (4 * density))) + 1
+        for i in range(4):
+            lo = start if direction == "down" else max(0, start - w)
+            hi = end if direction == "up" else end + w
+            feats = self._overlapping(table, chrom, lo, hi, columns)
+            if direction == "up":
+                feats = [f for f in feats if f.start <= end]
+            elif direction == "down":
+                feats = [f for f in feats if f.end >= start]
+            if len(feats) >= k:
+                # anything outside the window is further away than w (or
+                # there is nothing left of it).
+                dists = sorted(max(0, start - f.end, f.start - end)
+                               for f in feats)
+                if dists[k - 1] <= w or (direction == "up" and lo == 0):
+                    return feats
+            w *= 4
+        return None
+
+    def _max_length(self, tbl, chrom):
+        """
+        internal: the length of the longest feature of `tbl` on `chrom`. This
+        is read from the database the first time for each chromosome and
+        kept until rows are added to the table (see `_forget`). The `stats`
+        aren't used as they may be older than the rows.
+        """
+        key = (tbl.name, chrom)
+        try:
+            return self._max_lengths[key]
+        except KeyError:
+            cstart, cend = _start_end_columns(tbl)
+            n = self.session.connection(bind=self.engine).execute(
+                    select([func.max(cend - cstart)]).where(
+                        tbl.c.chrom == chrom)).scalar()
+            self._max_lengths[key] = n = long(n or 0)
+            return n
+
+    def _forget(self, table):
+        """
+        internal: drop the longest features read for `table` after rows were
+        added to it as the starts of spatial queries are bounded by them.
+        """
+        for key in [k for k in self._max_lengths if k[0] == table]:
+            del self._max_lengths[key]
+
+    def _plan(self, tbl, chrom, start, end):
+        """
+        internal: return (ranges, None) with the bin ranges for a query of
+        `tbl` or else (None, lowest) with the lowest start that a feature
+        overlapping `start` can have. If there are `stats` for `tbl`, the one
+        expected to read fewer rows is used; otherwise the bins are used
+        unless there are MAX_BINS or more of them.
+        """
+        ranges = _bin_ranges(start, end) if hasattr(tbl.c, "bin") else None
+        if ranges is not None:
+            st = self._known_stats(tbl)
+            if st is None:
+                if sum(last - first + 1 for first, last in ranges) < MAX_BINS:
+                    return ranges, None
+            else:
+                # without an index on the start, the whole chrom is read.
+                by_start = st.rows.get(chrom, 0)
+                if st.has_index("chrom", _start_end_columns(tbl)[0].name):
+                    by_start *= min(1.0, (end - start + st.max_length.get(
+                        chrom, 0)) / float(max(1, st.span.get(chrom, 0))))
+                if st.bin_rows(chrom, ranges) <= by_start:
+                    return ranges, None
+        return None, start - self._max_length(tbl, chrom)
+
+    def _known_stats(self, tbl):
+        """
+        internal: the TableStats for `tbl` if they have been read (by
+        `stats` or from the cruzdb_stats table of a mirror) or else None.
+        """
+        if self._table_stats is None:
+            from .stats import load
+            self._table_stats = load(self.engine)
+        return self._table_stats.get(tbl.name)
+
+    def stats(self, table, refresh=False):
+        """
+        return a `cruzdb.stats.TableStats` for `table` with the number of rows
+        and the length of the longest feature on each chromosome, a
+        histogram of feature lengths and of bins, and the indexes. These are
+        used to choose how to run `bin_query`, `knearest` and `annotate`.
+
+        They are read from the database (with a scan of the table) the first
+        time and kept for the session. Mirrors (see `mirror`) keep them in
+        their cruzdb_stats table so they are only read again with `refresh`.
+
+        Parameters
+        ----------
+
+        table : str or table
+            table (or query on the table) to get the stats for
+
+        refresh : bool
+            read them from the database even if they are known
+        """
+        from .stats import compute, stats_table, save
+        tbl = self._table_for(table)[1]
+        st = self._known_stats(tbl)
+        if st is None or refresh:
+            st = self._table_stats[tbl.name] = compute(self, tbl)
+            if stats_table(self.engine) is not None:
+                save(self.engine, st)
+        return st
+
+    def _compiled(self, tbl, columns, binned):
+        """
+        internal: the compiled select of `columns` (or all columns) of `tbl`
+        with `_spatial_clause`. Statements are compiled once for each table
+        and shape of query.
+        """
+        key = (tbl.name, columns and tuple(columns), binned)
+        try:
+            return self._statements[key]
+        except KeyError:
+            cols = [tbl] if columns is None else \
+                    [tbl.c[c] for c in _projection(tbl, columns)]
+            stmt = select(cols).where(_spatial_clause(tbl, binned))
+            compiled = stmt.compile(dialect=self.engine.dialect)
+            self._statements[key] = compiled
+            return compiled
+
+    def rows(self, table, chrom=None, start=None, end=None, columns=None):
+        """
+        return the rows of `table` (on `chrom` and overlapping `start`, `end`
+        if they are given) as lightweight, read-only
+        `cruzdb.models.Record`s. These have the same helpers (start, end,
+        exons, distance, bed, ...) as the mapped objects, but they come from
+        a Core select so there is no mapper, identity map or change
+        tracking, which is much faster for large results.
+
+        Parameters
+        ----------
+
+        table : str or table
+           table (or query) to select from
+
+        chrom : str
+           chromosome
+
+        start, end : int
+            0-based positions as for `bin_query`
+
+        columns : list
+            names of the columns to select (chrom, start and end are always
+            included)
+        """
+        from .models import Record
+        table, tbl = self._table_for(table)
+        if start is not None and not isinstance(table, Query):
+            binned, params = _spatial_params(tbl, chrom, start, end,
+                                             self._plan)
+            res = self.session.connection(bind=self.engine).execute(
+                    self._compiled(tbl, columns, binned), params)
+            record = Record.for_table(tbl.name, res.keys(),
+                                      self.engine.url.database)
+            return CachedRows(record(row) for row in res.fetchall())
+
+        stmt = table.statement if isinstance(table, Query) else \
+                tbl.select()
+        if columns is not None:
+            stmt = stmt.with_only_columns([tbl.c[c] for c in
+                                           _projection(tbl, columns)])
+        if start is not None:
+            stmt = stmt.where(_bin_clause(tbl, chrom, start, end,
+                                          self._plan))
+        elif chrom is not None:
+            stmt = stmt.where(tbl.c.chrom == chrom)
+        res = self.session.execute(stmt)
+        record = Record.for_table(tbl.name, res.keys(),
+                                  self.engine.url.database)
+        return CachedRows(record(row) for row in res.fetchall())
+
+    def bin_query_many(self, table, regions, chunk=500):
+        """
+        perform the same spatial query as `bin_query` for many regions at
+        once. Rather than sending one statement per region, up to `chunk`
+        regions are sent in each statement. This makes a large difference
+        when the database is remote.
+
+        Yields (index, feature) tuples where index is the 0-based index of
+        the region in `regions` that the feature overlaps. Results are
+        yielded in order of index. A feature that overlaps more than one
+        region is yielded once for each region.
+
+        Parameters
+        ----------
+
+        table : str or table
+           table to query
+
+        regions : iterable
+           iterable of (chrom, start, end) tuples or of features with
+           .chrom, .start, .end attributes
+
+        chunk : int
+           number of regions to send in each statement
+        """
+        from .intersecter import Intersecter
+        table, tbl = self._table_for(table)
+
+        def query_chunk(block):
+            # the same filter as bin_query for each region.
+            clauses = [_bin_clause(tbl, r.chrom, r.start, r.end, self._plan)
+                       for r in block]
+
+            # use the intersecter to match returned rows back to regions.
+            tree = Intersecter(block)
+            res = []
+            for feat in table.filter(or_(*clauses)):
+                res.extend((r.index, feat) for r in tree.find(feat.start,
+                                                    feat.end, feat.chrom))
+            res.sort(key=itemgetter(0))
+            return res
+
+        block = []
+        for i, region in enumerate(regions):
+            if isinstance(region, (tuple, list)):
+                chrom, start, end = region[:3]
+            else:
+                chrom, start, end = region.chrom, region.start, region.end
+            block.append(_Region(chrom, long(start), long(end), i))
+            if len(block) == chunk:
+                for r in query_chunk(block): yield r
+                block = []
+        if block:
+            for r in query_chunk(block): yield r
+
+    def knearest_many(self, table, regions, k=1, chunk=20000):
+        """
+        find the k nearest features (as `knearest`) for many regions with a
+        few set-based statements rather than several statements per region.
+
+        The regions are uploaded, along with their bin ranges, to a temporary
+        table on the server. That is joined to `table` first to find
+        overlaps and then in rounds of wider windows for the regions that
+        do not yet have k neighbors. Regions that still need more after the
+        widest window (or if the temporary table can't be created) use
+        `knearest`.
+
+        Yields (index, [features]) for every region in order of index where
+        index is the 0-based index of the region in `regions`.
+
+        Parameters
+        ----------
+
+        table : str or table
+           table to query
+
+        regions : iterable
+           iterable of (chrom, start, end) tuples or of features with
+           .chrom, .start, .end attributes
+
+        k : int
+           number of neighbors to find for each region
+
+        chunk : int
+           number of regions to upload at a time
+        """
+        table, tbl = self._table_for(table)
+
+        block = []
+        for i, region in enumerate(regions):
+            if isinstance(region, (tuple, list)):
+                chrom, start, end = region[:3]
+            else:
+                chrom, start, end = region.chrom, region.start, region.end
+            block.append(_Region(chrom, long(start), long(end), i))
+            if len(block) < chunk: continue
+            for r in self._knearest_chunk(table, tbl, block, k): yield r
+            block = []
+        if block:
+            for r in self._knearest_chunk(table, tbl, block, k): yield r
+
+    def _knearest_chunk(self, table, tbl, block, k):
+        """
+        internal: knearest_many for a list of _Regions. returns a list of
+        (index, [features]).
+        """
+        from sqlalchemy import Table, Column, Integer, BigInteger, String, \
+                MetaData
+        from sqlalchemy.exc import SQLAlchemyError
+        from sqlalchemy.orm import Session
+        from .sweep import _k_with_ties
+        cstart, cend = _start_end_columns(tbl)
+        has_bin = hasattr(tbl.c, "bin")
+
+        regions = Table("cruzdb_regions", MetaData(),
+                        Column("rid", Integer), Column("rchrom", String(255)),
+                        Column("rstart", BigInteger), Column("rend", BigInteger),
+                        Column("rfirst", Integer), Column("rlast", Integer),
+                        prefixes=["TEMPORARY"])
+        # a session of its own so its transaction (which holds the temporary
+        # table and, on sqlite, the write lock) is ended here rather than
+        # left open on self.session.
+        session = Session(bind=self.engine, expire_on_commit=False)
+        conn = session.connection()
+        try:
+            regions.create(conn)
+        except SQLAlchemyError:
+            # e.g. no permission to create temporary tables.
+            session.rollback()
+            return [(r.index, self.knearest(table, r.chrom, r.start, r.end, k))
+                    for r in block]
+
+        q = table.with_session(session).add_columns(regions.c.rid).filter(
+                tbl.c.chrom == regions.c.rchrom).filter(
+                cstart <= regions.c.rend).filter(cend >= regions.c.rstart)
+        if has_bin:
+            # one row for each level of bins (as in _bin_clause).
+            q = q.filter(tbl.c.bin.between(regions.c.rfirst, regions.c.rlast))
+
+        found = {}
+        pending = dict(enumerate(block))
+        try:
+            # the first window finds overlaps, like bin_query.
+            for window in (0, 16384, 131072, 1048576):
+                rows = []
+                for rid, r in pending.items():
+                    start, end = max(0, r.start - window), r.end + window
+                    if not has_bin:
+                        rows.append((rid, r.chrom, start, end, None, None))
+                        continue
+                    try:
+                        ranges = _bin_ranges(start, end)
+                    except BigException:
+                        continue
+                    rows.extend((rid, r.chrom, start, end, first, last)
+                                for first, last in ranges)
+                if not rows: break
+                conn.execute(regions.delete())
+                conn.execute(regions.insert(), [dict(zip(("rid", "rchrom",
+                    "rstart", "rend", "rfirst", "rlast"), row)) for row in rows])
+
+                cands = {}
+                for row in q:
+                    cands.setdefault(row[-1], []).append(row[0])
+                for rid, feats in cands.items():
+                    r = pending[rid]
+                    dists = [(max(0, r.start - f.end, f.start - r.end), f)
+                             for f in feats]
+                    feats = _k_with_ties(dists, k)
+                    # everything outside the window is further away than
+                    # `window` so the neighbors are known if the kth is inside.
+                    if len(feats) >= k and dists[k - 1][0] <= window:
+                        found[rid] = feats
+                        del pending[rid]
+                if not pending: break
+        finally:
+            try:
+                regions.drop(conn)
+            finally:
+                session.commit()
+
+        for rid, r in pending.items():
+            found[rid] = list(self.knearest(table, r.chrom, r.start, r.end, k))
+        return [(block[rid].index, found[rid]) for rid in range(len(block))]
+
+    def stream(self, table, chunk=8000, columns=None):
+        """
+        iterate over the rows of a table in time linear in its size and with
+        memory for only `chunk` rows at a time. Rows are read in pages that
+        are ordered by the primary key (or an index) and each page starts
+        after the key of the last row of the previous one. If the table has
+        no index, a server-side cursor is used instead.
+
+        Parameters
+        ----------
+
+        table : str or table
+           table (or query) to read
+
+        chunk : int
+           number of rows to read with each statement
+
+        columns : list
+            names of the columns to load; see `bin_query`
+        """
+        table, tbl = self._table_for(table)
+        if columns is not None:
+            key, _ = _keyset_columns(tbl)
+            table = self._table_for(table, list(columns) + [c.name for c in
+                                                      key or ()])[0]
+        return _stream_query(table, tbl, chunk)
+
+    def _table_for(self, table, columns=None):
+        """
+        internal: return the mapped table (or query) and the underlying
+        sqlalchemy Table for `table` which can be a table name, a mapped table
+        or a query. If `columns` are given, the rest are deferred.
         """
         if isinstance(table, six.string_types):
             table = getattr(self, table)
@@ -278,17 +1104,38 @@ class Genome(soup.Genome):
             tbl = table._table
         except AttributeError:
             tbl = table.column_descriptions[0]['type']._table
+        if columns is not None:
+            from sqlalchemy.orm import load_only
+            table = table.options(load_only(*_projection(tbl, columns)))
+        return table, tbl
+
+    def build_index(self, table, path):
+        """
+        write a sorted, columnar interval index of `table` to `path`.
+        The index can be memory-mapped with
+        `cruzdb.intersecter.Intersecter.open` which gives an in-memory
+        `ArrayIntersecter` without reading the table from the database
+        again. Rows are returned from it as `cruzdb.models.Record`s.
 
-        q = table.filter(tbl.c.chrom == chrom)
+        Parameters
+        ----------
 
-        if hasattr(tbl.c, "bin"):
-            bins = Genome.bins(start, end)
-            if len(bins) < 100:
-                q = q.filter(tbl.c.bin.in_(bins))
+        table : str or table
+            table (or query) to index
 
-        if hasattr(tbl.c, "txStart"):
-            return q.filter(tbl.c.txStart <= end).filter(tbl.c.txEnd >= start)
-        return q.filter(tbl.c.chromStart <= end).filter(tbl.c.chromEnd >= start)
+        path : str
+            file to write
+        """
+        from .intersecter import write_index
+        table, tbl = self._table_for(table)
+        cstart, cend = _start_end_columns(tbl)
+        stmt = table.order_by(tbl.c.chrom, cstart).statement
+        res = self.engine.execute(stmt.execution_options(stream_results=True))
+        cols = list(res.keys())
+        write_index(path, res, cols.index("chrom"), cols.index(cstart.name),
+                    cols.index(cend.name), columns=cols, table=tbl.name,
+                    db=self.engine.url.database)
+        return path
 
     def upstream(self, table, chrom_or_feat, start=None, end=None, k=1):
         """
@@ -355,7 +1202,7 @@ class Genome(soup.Genome):
             return [x for x in res if x.end > start]
 
     def knearest(self, table, chrom_or_feat, start=None, end=None, k=1,
-            _direction=None):
+            _direction=None, columns=None):
         """
         Return k-nearest features
 
@@ -380,6 +1227,9 @@ class Genome(soup.Genome):
 
         _direction : (None, "up", "down")
             internal (don't use this)
+
+        columns : list
+            names of the columns to load; see `bin_query`
         """
         assert _direction in (None, "up", "down")
 
@@ -392,26 +1242,44 @@ class Genome(soup.Genome):
             # adjust...
             if _direction in ("up", "down") and getattr(chrom_or_feat,
                     "strand", None) == "-":
-                _direction = "up" if _direction == "down" else "up"
+                _direction = "up" if _direction == "down" else "down"
         else:
             chrom = chrom_or_feat
 
-        qstart, qend = long(start), long(end)
-        res = self.bin_query(table, chrom, qstart, qend)
-
-        i, change = 1, 350
+        start, end = long(start), long(end)
+        cached = self.tile_cache is not None and \
+                 isinstance(table, six.string_types)
         try:
-            while res.count() < k:
-                if _direction in (None, "up"):
-                    if qstart == 0 and _direction == "up": break
-                    qstart = max(0, qstart - change)
-                if _direction in (None, "down"):
-                    qend += change
-                i += 1
-                change *= (i + 5)
-                res = self.bin_query(table, chrom, qstart, qend)
+            if self._tiled(table, start, end):
+                res = self.bin_query(table, chrom, start, end,
+                                     columns=columns).all()
+            else:
+                res = self._overlapping(table, chrom, start, end, columns)
         except BigException:
             return []
+        if cached and len(res) < k:
+            near = self.tile_cache.nearest(table, chrom, start, end, k,
+                                           self._tile_fetcher(table, chrom),
+                                           _direction)
+            if near is not None:
+                res = near
+
+        if len(res) < k and not cached:
+            near = self._window_nearest(table, chrom, start, end, k,
+                                        _direction, columns)
+            if near is not None:
+                res = near
+
+        # anything overlapping is at distance 0 so if there are already k
+        # overlaps, there's no need to look further. otherwise, get the k
+        # (plus ties) closest features on each side with an ordered scan.
+        if len(res) < k:
+            if _direction in (None, "up"):
+                res.extend(self._nearest(table, chrom, start, k, True,
+                                         columns))
+            if _direction in (None, "down"):
+                res.extend(self._nearest(table, chrom, end, k, False,
+                                         columns))
 
         def dist(f):
             d = 0
@@ -422,7 +1290,7 @@ class Genome(soup.Genome):
             # add dist as an attribute to the feature
             return d
 
-        dists = sorted([(dist(f), f) for f in res])
+        dists = sorted([(dist(f), f) for f in res], key=itemgetter(0))
         if len(dists) == 0:
             return []
 
@@ -449,7 +1317,8 @@ class Genome(soup.Genome):
         return self.engine.execute(query)
 
     def annotate(self, fname, tables, feature_strand=False, in_memory=False,
-            header=None, out=sys.stdout, parallel=False):
+            header=None, out=sys.stdout, parallel=False, sweep=False,
+            join=False):
         """
         annotate a file with a number of tables
 
@@ -466,10 +1335,14 @@ class Genome(soup.Genome):
             if this is True, then the up/downstream designations are based on
             the features in `tables` rather than the features in `fname`
 
-        in_memoory : bool
+        in_memoory : bool or "auto"
             if True, then tables are read into memory. This usually makes the
             annotation much faster if there are more than 500 features in
             `fname` and the number of features in the table is less than 100K.
+            If "auto" (and `sweep` and `join` are False), a plan is chosen for
+            each table from the size of the table and of `fname`, the latency
+            of the database and whether `fname` is sorted. The plan is
+            reported on stderr.
 
         header : str
             header to print out (if True, use existing header)
@@ -478,12 +1351,26 @@ class Genome(soup.Genome):
             where to print output
 
         parallel : bool
-            if True, use multiprocessing library to execute the annotation of
-            each chromosome in parallel. Uses more memory.
+            if True, use multiprocessing library to annotate blocks of lines
+            from `fname` in parallel. The output is written in the same order
+            as the input. If `in_memory` is also True, each
+            table index is built once (see `build_index`) and memory-mapped
+            by the workers so memory use doesn't grow with their number.
+
+        sweep : bool
+            if True, `fname` must be sorted by chromosome and then start.
+            The nearest features are then found with a single sort-merge
+            pass over each table (or over the in-memory tables).
+
+        join : bool
+            if True, the intervals in `fname` are uploaded in large blocks
+            to a temporary table and joined to each table on the server
+            (see `knearest_many`) rather than sending queries for each
+            interval. This is much faster for a remote database.
         """
         from .annotate import annotate
         return annotate(self, fname, tables, feature_strand, in_memory, header=header,
-                out=out, parallel=parallel)
+                out=out, parallel=parallel, sweep=sweep, join=join)
 
     @staticmethod
     def bins(start, end):
@@ -509,6 +1396,33 @@ class Genome(soup.Genome):
             end >>= binNextShift
         return frozenset(bins)
 
+    @staticmethod
+    def bins_array(starts, ends):
+        """
+        Get the smallest bin that contains each interval defined by the
+        (start, end] in the arrays `starts` and `ends`. This is the value of
+        the bin column in UCSC tables. Returns a numpy array.
+
+        >>> Genome.bins_array([0, 100000, 10000000], [100, 200000, 10000100]).tolist()
+        [585, 73, 661]
+        """
+        import numpy as np
+        start = np.asarray(starts, dtype=np.int64) >> 17
+        end = (np.asarray(ends, dtype=np.int64) - 1) >> 17
+        bins = np.zeros(len(start), dtype=np.int64)
+        todo = np.ones(len(start), dtype=bool)
+        for offset in (585, 73, 9, 1):
+            found = todo & (start == end)
+            bins[found] = offset + start[found]
+            todo &= ~found
+            start >>= 3
+            end >>= 3
+        # the rest are in bin 0 unless they cross a 512Mb boundary, which
+        # needs the extended binning scheme.
+        if (todo & (start != end)).any():
+            raise BigException
+        return bins
+
     def __repr__(self):
         return "%s('%s')" % (self.__class__.__name__, self.dburl)
 
@@ -1,7 +1,10 @@
 from __future__ import print_function
 import sys
 import os
-from cruzdb.models import Feature, ABase
+import time
+from itertools import chain, count, islice
+from six import StringIO
+from cruzdb.models import Feature, _Row
 from toolshed import reader, nopen
 
 if sys.version_info[0] >= 3:
@@ -15,28 +18,296 @@ def _annotate(args):
         print(args, file=sys.stderr)
         raise
 
-def _split_chroms(fname):
+# the ways annotate can find the nearest features in a table:
+#   sql: a knearest query for each interval
+#   join: blocks of intervals joined to the table on the server
+#   memory: the table is read into an Intersecter
+#   sweep: a sort-merge pass over the table (input sorted by chrom, start)
+#   memory-sweep: a sort-merge pass over the table read into an Intersecter
+MODES = ("sql", "join", "memory", "sweep", "memory-sweep")
+
+# number of input lines read ahead to choose a mode for each table
+PLAN_SAMPLE = 10000
+
+# rough costs (in seconds) used to choose a mode for each table
+ROW_COST = 2e-5     # fetch a row and make a python object from it
+QUERY_COST = 3e-4   # send a small statement (not counting latency)
+SEARCH_COST = 2e-5  # an in-memory knearest search
+
+# tables with more rows than this are never read into memory
+MAX_MEMORY_ROWS = 5000000
+
+def _explicit_modes(tables, in_memory, sweep, join):
+    """the mode for each table from the options sent to annotate"""
+    # "auto" only plans when neither sweep nor join was asked for.
+    in_memory = in_memory and in_memory != "auto"
+    if sweep:
+        mode = "memory-sweep" if in_memory else "sweep"
+    elif in_memory:
+        mode = "memory"
+    else:
+        mode = "join" if join else "sql"
+    return [mode] * len(tables)
+
+def _sample_intervals(sample):
+    """(chrom, start) for each row in sample that is not a header"""
+    for toks in sample:
+        if isinstance(toks, _Row):
+            yield toks.chrom, toks.start
+        elif len(toks) > 2 and (toks[1] + toks[2]).isdigit():
+            yield toks[0], int(toks[1])
+
+def _is_sorted(intervals):
+    """are (chrom, start) intervals sorted by start within each chrom?"""
+    seen, last_chrom, last_start = set(), None, None
+    for chrom, start in intervals:
+        if chrom != last_chrom:
+            if chrom in seen: return False
+            seen.add(chrom)
+        elif start < last_start:
+            return False
+        last_chrom, last_start = chrom, start
+    return True
+
+def _estimate_size(fname, sample):
+    """
+    estimate the number of intervals in fname from the first PLAN_SAMPLE
+    rows without reading the rest of it.
+    """
+    if len(sample) < PLAN_SAMPLE:
+        return sum(1 for _ in _sample_intervals(sample))
+    if isinstance(fname, basestring) and os.path.exists(fname):
+        size = os.path.getsize(fname) * (4 if fname.endswith(".gz") else 1)
+        line = sum(len(t) for toks in sample for t in toks) + \
+               sum(len(toks) for toks in sample)
+        return int(size / (float(line) / len(sample)))
+    return 10 * PLAN_SAMPLE
+
+def plan(g, tables, sample, n=None):
+    """
+    choose a mode (one of MODES) to annotate with each table. This uses
+    the number of rows in each table, the round-trip time to the database,
+    the number of intervals (`n`, estimated from `sample` if it's None)
+    and whether the intervals in `sample` are sorted. The number of rows
+    comes from `Genome.stats` when they are known rather than a count.
+    """
+    intervals = list(_sample_intervals(sample))
+    if n is None: n = len(intervals)
+    is_sorted = _is_sorted(intervals)
+    nchroms = len(set(c for c, s in intervals))
+
+    latency = []
+    for i in range(3):
+        t0 = time.time()
+        g.engine.execute("SELECT 1").fetchall()
+        latency.append(time.time() - t0)
+    per_query = min(latency) + QUERY_COST
+
+    from sqlalchemy import func
+    from sqlalchemy.orm.query import Query
+    modes = []
+    for t in tables:
+        q, tbl = g._table_for(t)
+        st = g._known_stats(tbl)
+        if st is not None and not isinstance(q, Query):
+            rows = st.count
+        else:
+            rows = q.with_entities(func.count(tbl.c.chrom)).scalar()
+        costs = {"sql": 3 * n * per_query,
+                 "join": 12 * (n // JOIN_BLOCK + 1) * per_query
+                        + 8 * n * ROW_COST}
+        if rows <= MAX_MEMORY_ROWS:
+            costs["memory"] = rows * ROW_COST + n * SEARCH_COST
+        if is_sorted:
+            costs["sweep"] = rows * ROW_COST + 2 * nchroms * per_query \
+                             + n * SEARCH_COST / 4
+            if rows <= MAX_MEMORY_ROWS:
+                costs["memory-sweep"] = rows * ROW_COST + n * SEARCH_COST / 4
+        mode = min(costs, key=costs.get)
+        print("annotate: using %s for %s (%i rows, ~%i intervals%s)" % (mode,
+                  tbl.name, rows, n, ", sorted" if is_sorted else ""),
+              file=sys.stderr)
+        modes.append(mode)
+    return modes
+
+def _build_indexes(g, tables, modes):
+    """
+    write a memory-mappable index (see Genome.build_index) of each table
+    that is used in memory to a temporary file and return the paths (None
+    for the other tables).
+    """
     import tempfile
-    t = tempfile.mktemp(dir="/tmp", suffix=".cruzdb")
-    chroms = {}
-    for d in reader(fname, header="ordered"):
-        if not d['chrom'] in chroms:
-            chroms[d['chrom']] = open(t + "." + d['chrom'], "w")
-            print("\t".join(d.keys()), file=chroms[d['chrom']])
-        print("\t".join(d.values()), file=chroms[d['chrom']])
-    for k in chroms:
-        chroms[k].close()
-        chroms[k] = (chroms[k], chroms[k].name + ".anno")
-    return chroms.items()
+    paths = []
+    for t, mode in zip(tables, modes):
+        if not mode.startswith("memory"):
+            paths.append(None)
+            continue
+        fh, path = tempfile.mkstemp(suffix=".cruzdb.idx")
+        os.close(fh)
+        paths.append(g.build_index(t, path))
+    return paths
+
+def _finder(g, t, mode, index=None, chrom=None):
+    """
+    return a function that takes a feature and returns the nearest
+    features in table t using `mode`. for the join mode this is None; the
+    neighbors come from _join_nearest.
+    """
+    if mode == "join":
+        return None
+    if mode == "sql":
+        return lambda f: g.knearest(t, f.chrom, f.start, f.end, k=1)
+    from .sweep import Sweep
+    if mode == "sweep":
+        return Sweep(t, k=1, genome=g).knearest
+    from .intersecter import Intersecter
+    if index is not None:
+        tree = Intersecter.open(index)
+    else:
+        q = getattr(g, t) if isinstance(t, basestring) else t
+        if chrom is not None:
+            q = q.filter_by(chrom=chrom)
+        tree = Intersecter(q)
+    if mode == "memory-sweep":
+        return Sweep(tree, k=1).knearest
+    return lambda f: tree.knearest(f.start, f.end, chrom=f.chrom, k=1)
+
+# number of input lines sent to a worker at a time with parallel=True
+PARALLEL_BLOCK = 5000
+
+# a Genome per database in each worker process.
+_worker_genomes = {}
+
+def _annotate_block(args):
+    """
+    annotate a block of lines in a worker process and return the output
+    as a string.
+    """
+    (db, lines, tables, feature_strand, header, modes, indexes,
+            print_header) = args
+    from . import Genome
+    if not db in _worker_genomes:
+        _worker_genomes[db] = Genome(db)
+    out = StringIO()
+    annotate(_worker_genomes[db], (l.rstrip("\r\n").split("\t") for l in lines),
+             tables, feature_strand, header=header, out=out, _modes=modes,
+             _indexes=indexes, _print_header=print_header)
+    return out.getvalue()
+
+def _annotate_parallel(g, fname, tables, feature_strand, in_memory, header,
+                       out, sweep, join, processes=None):
+    """
+    send blocks of lines from fname to a pool of processes and write the
+    annotated blocks to out in the order they were read. only a few blocks
+    per process are held in memory at any time.
+    """
+    import multiprocessing
+    import signal
+    from collections import deque
+    if isinstance(g, basestring):
+        from . import Genome
+        g = Genome(g)
+
+    lines = iter(nopen(fname) if isinstance(fname, basestring) else fname)
+    first = next(lines, None)
+    if first is None: return
+    toks = first.rstrip("\r\n").split("\t")
+    if not header and not (toks[1] + toks[2]).isdigit():
+        header = toks
+    if header != toks:
+        lines = chain([first], lines)
+
+    if in_memory == "auto" and not (sweep or join):
+        sample = list(islice(lines, PLAN_SAMPLE))
+        lines = chain(sample, lines)
+        sample = [l.rstrip("\r\n").split("\t") for l in sample]
+        modes = plan(g, tables, sample, _estimate_size(fname, sample))
+    else:
+        modes = _explicit_modes(tables, in_memory, sweep, join)
+
+    # build each index once and let the workers memory-map it rather than
+    # each reading the tables from the database.
+    indexes = _build_indexes(g, tables, modes)
+    processes = processes or multiprocessing.cpu_count()
+    p = multiprocessing.Pool(processes, initializer=lambda:
+                            signal.signal(signal.SIGINT, signal.SIG_IGN))
+    try:
+        pending = deque()
+        for i in count():
+            block = list(islice(lines, PARALLEL_BLOCK))
+            if not block: break
+            pending.append(p.apply_async(_annotate_block,
+                ((g.db, block, tables, feature_strand, header, modes,
+                  indexes, i == 0),)))
+            if len(pending) >= 2 * processes:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+        p.close()
+    except:
+        p.terminate()
+        raise
+    finally:
+        p.join()
+        for path in indexes:
+            if path is not None:
+                os.unlink(path)
+
+# number of input lines sent to Genome.knearest_many at a time in join mode
+JOIN_BLOCK = 20000
+
+def _join_nearest(g, rows, tables, chunk=JOIN_BLOCK):
+    """
+    yield (toks, neighbors) for each row where neighbors is a list with the
+    nearest features from each table (None for tables that are None).
+    they are found with Genome.knearest_many for `chunk` rows at a time.
+    header rows get None.
+    """
+    rows = iter(rows)
+    while True:
+        block = list(islice(rows, chunk))
+        if not block: break
+        regions, idxs = [], []
+        for i, toks in enumerate(block):
+            if isinstance(toks, _Row):
+                regions.append((toks.chrom, toks.start, toks.end))
+            elif (toks[1] + toks[2]).isdigit():
+                regions.append((toks[0], int(toks[1]), int(toks[2])))
+            else:
+                continue
+            idxs.append(i)
+        neighbors = [None] * len(block)
+        for i in idxs:
+            neighbors[i] = [None] * len(tables)
+        for ti, t in enumerate(tables):
+            if t is None: continue
+            for ri, objs in g.knearest_many(t, regions, k=1):
+                neighbors[idxs[ri]][ti] = objs
+        for toks, n in zip(block, neighbors):
+            yield toks, n
 
 def annotate(g, fname, tables, feature_strand=False, in_memory=False,
-        header=None, out=sys.stdout, _chrom=None, parallel=False):
+        header=None, out=sys.stdout, _chrom=None, parallel=False, sweep=False,
+        join=False, _indexes=None, _print_header=True, _modes=None):
     """
     annotate bed file in fname with tables.
     distances are integers for distance. and intron/exon/utr5 etc for gene-pred
     tables. if the annotation features have a strand, the distance reported is
     negative if the annotation feature is upstream of the feature in question
     if feature_strand is True, then the distance is negative if t
+    if in_memory is "auto" and sweep and join are False, a mode (see MODES) is
+    chosen for each table by `plan` from the first PLAN_SAMPLE lines of fname
+    and some cheap statistics about the tables. the plan is reported on
+    stderr.
+    if sweep is True, fname should be sorted by chrom, start and the nearest
+    features are found in a single sort-merge pass over each table.
+    if join is True (and in_memory and sweep are not), blocks of JOIN_BLOCK
+    lines are uploaded to a temporary table on the server and joined to each
+    table (see Genome.knearest_many).
+    if parallel is True, blocks of PARALLEL_BLOCK lines are annotated by a
+    pool of processes and written out in the order of the input. each table
+    that is used in memory is indexed once and shared with the workers as a
+    memory-mapped file.
     """
     close = False
     if isinstance(out, basestring):
@@ -45,49 +316,37 @@ def annotate(g, fname, tables, feature_strand=False, in_memory=False,
 
 
     if parallel:
-        import multiprocessing
-        import signal
-        p = multiprocessing.Pool(initializer=lambda:
-                                signal.signal(signal.SIGINT, signal.SIG_IGN))
-        chroms = _split_chroms(fname)
-
-        def write_result(fanno, written=[False]):
-            for i, d in enumerate(reader(fanno, header="ordered")):
-                if i == 0 and written[0] == False:
-                    print("\t".join(d.keys()), file=out)
-                    written[0] = True
-                print("\t".join(x if x else "NA" for x in d.values()), file=out)
-            os.unlink(fanno)
-            os.unlink(fanno.replace(".anno", ""))
-
-        for fchrom, (fout, fanno) in chroms:
-            p.apply_async(annotate, args=(g.db, fout.name, tables, feature_strand, False, # True causes it to silently fail, resulting in nothing being writting in the output file
-                                 header, fanno, fchrom),
-                                 callback=write_result)
-        p.close()
-        p.join()
-        return out.name
+        _annotate_parallel(g, fname, tables, feature_strand, in_memory,
+                           header, out, sweep, join)
+        if close:
+            out.close()
+        return getattr(out, "name", None)
 
     if isinstance(g, basestring):
         from . import Genome
         g = Genome(g)
-    if in_memory:
-        from . intersecter import Intersecter
-        intersecters = [] # 1 per table.
-        for t in tables:
-            q = getattr(g, t) if isinstance(t, basestring) else t
-            if _chrom is not None:
-                q = q.filter_by(chrom=_chrom)
-            table_iter = q #page_query(q, g.session)
-            intersecters.append(Intersecter(table_iter))
-
-    elif isinstance(fname, basestring) and os.path.exists(fname) \
-            and sum(1 for _ in nopen(fname)) > 25000:
-        print("annotating many intervals, may be faster using in_memory=True", file=sys.stderr)
+
+    rows = reader(fname, header=False)
+    if _modes is None and in_memory == "auto" and not (sweep or join):
+        # read ahead (but only once) to choose a mode for each table.
+        rows = iter(rows)
+        sample = list(islice(rows, PLAN_SAMPLE))
+        rows = chain(sample, rows)
+        _modes = plan(g, tables, sample, _estimate_size(fname, sample))
+    elif _modes is None:
+        _modes = _explicit_modes(tables, in_memory, sweep, join)
+    finders = [_finder(g, t, mode, _indexes[ti] if _indexes else None, _chrom)
+               for ti, (t, mode) in enumerate(zip(tables, _modes))]
+
     if header is None:
         header = []
     extra_header = []
-    for j, toks in enumerate(reader(fname, header=False)):
+    if "join" in _modes:
+        rows = _join_nearest(g, rows, [t if mode == "join" else None
+                                       for t, mode in zip(tables, _modes)])
+    else:
+        rows = ((toks, None) for toks in rows)
+    for j, (toks, joined) in enumerate(rows):
         if j == 0 and not header:
             if not (toks[1] + toks[2]).isdigit():
                 header = toks
@@ -100,10 +359,11 @@ def annotate(g, fname, tables, feature_strand=False, in_memory=False,
             if 0 != len(header):
                 if not header[0].startswith("#"):
                     header[0] = "#" + header[0]
-                print("\t".join(header + extra_header), file=out)
+                if _print_header:
+                    print("\t".join(header + extra_header), file=out)
             if header == toks: continue
 
-        if not isinstance(toks, ABase):
+        if not isinstance(toks, _Row):
             f = Feature()
             f.chrom = toks[0]
             f.txStart = int(toks[1])
@@ -120,10 +380,10 @@ def annotate(g, fname, tables, feature_strand=False, in_memory=False,
             toks = f.bed(*header).split("\t")
         sep = "^*^"
         for ti, tbl in enumerate(tables):
-            if in_memory:
-                objs = intersecters[ti].knearest(int(toks[1]), int(toks[2]), chrom=toks[0], k = 1)
+            if finders[ti] is None:
+                objs = joined[ti]
             else:
-                objs = g.knearest(tbl, toks[0], int(toks[1]), int(toks[2]), k=1)
+                objs = finders[ti](f)
             if len(objs) == 0:
                 print("\t".join(toks + ["", "", ""]), file=out)
                 continue
@@ -172,4 +432,4 @@ def annotate(g, fname, tables, feature_strand=False, in_memory=False,
 
     if close:
         out.close()
-    return out.name
+    return getattr(out, "name", None)
@@ -0,0 +1,288 @@
+"""
+Caches of the rows of a table in fixed-size tiles of each chromosome.
+Repeated spatial queries on nearby coordinates (dense peak files, sliding
+windows) are answered from the tiles rather than by going back to the
+database.
+
+Tiles are the 128kb level-0 bins of the UCSC binning scheme. A whole tile
+is fetched the first time any query touches it. `TileCache` keeps tiles
+in memory and evicts the least-recently used once it holds more than
+`max_rows` rows (see the `tile_cache` argument to `cruzdb.Genome`).
+`LocalTileCache` saves them to a local database so they are kept between
+sessions (see the `cache` argument to `cruzdb.Genome`); a TileCache is
+kept in front of it.
+"""
+from collections import OrderedDict
+
+# each tile covers 2 ** TILE_SHIFT bases (the smallest UCSC bin).
+TILE_SHIFT = 17
+
+# queries that span more tiles than this are not cached.
+MAX_TILES = 64
+
+class CachedRows(list):
+    """
+    a list of rows with the parts of the Query interface that are used on
+    the result of `Genome.bin_query`.
+    """
+    def all(self):
+        return list(self)
+
+    def first(self):
+        return self[0] if self else None
+
+    def count(self):
+        return len(self)
+
+
+class _Tiles(object):
+    """
+    spatial queries from tiles. subclasses implement tile(key, fetch).
+    """
+
+    def tile(self, key, fetch):
+        raise NotImplementedError
+
+    def overlapping(self, table, chrom, start, end, fetch):
+        """
+        return the rows in `table` that overlap `start`, `end` (inclusive
+        like `Genome.bin_query`). `fetch(tile_start, tile_end)` should return
+        the rows from the database that overlap a tile.
+        """
+        start = max(0, start)
+        res = []
+        for t in range(start >> TILE_SHIFT, (end >> TILE_SHIFT) + 1):
+            rows = self.tile((table, chrom, t), lambda: fetch(
+                     t << TILE_SHIFT, ((t + 1) << TILE_SHIFT) - 1))
+            for f in rows:
+                # a feature in several tiles is reported from the first tile
+                # where it overlaps the query.
+                if f.start <= end and f.end >= start and \
+                        max(f.start, start) >> TILE_SHIFT == t:
+                    res.append(f)
+        return res
+
+    def nearest(self, table, chrom, start, end, k, fetch, direction=None):
+        """
+        return the features in tiles near `start`, `end` that include the k
+        nearest features (and any ties). Tiles on either side (or only
+        upstream or downstream for `direction` "up" or "down") are added
+        until the kth nearest is known. Returns None if it is not found
+        within 8 tiles of the query.
+        """
+        first, last = start >> TILE_SHIFT, end >> TILE_SHIFT
+        for w in (1, 2, 4, 8):
+            lo = first if direction == "down" else max(0, first - w)
+            hi = last if direction == "up" else last + w
+            feats = self.overlapping(table, chrom, lo << TILE_SHIFT,
+                                     ((hi + 1) << TILE_SHIFT) - 1, fetch)
+            if direction == "up":
+                feats = [f for f in feats if f.start <= end]
+            elif direction == "down":
+                feats = [f for f in feats if f.end >= start]
+            if len(feats) < k: continue
+
+            # anything outside the searched tiles is at least this far away.
+            covered = []
+            if direction != "down" and lo > 0:
+                covered.append(start - (lo << TILE_SHIFT))
+            if direction != "up":
+                covered.append(((hi + 1) << TILE_SHIFT) - 1 - end)
+            dists = sorted(max(0, start - f.end, f.start - end) for f in feats)
+            if not covered or dists[k - 1] <= min(covered):
+                return feats
+        return None
+
+
+class TileCache(_Tiles):
+    """
+    LRU cache of the rows in (table, chrom, tile) tiles.
+
+    Parameters
+    ----------
+
+    max_rows : int
+        memory budget as the total number of rows held in all tiles. A
+        feature that spans several tiles is counted once per tile.
+
+    backing : LocalTileCache
+        if specified, tiles that are not in memory are read through this
+        rather than directly from the database.
+
+    Attributes
+    ----------
+
+    hits, misses : int
+        number of tiles that were (or were not) found in the cache
+
+    evictions : int
+        number of tiles removed to stay within `max_rows`
+    """
+
+    def __init__(self, max_rows=500000, backing=None):
+        self.max_rows, self.backing = max_rows, backing
+        self._tiles = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        """remove all tiles and reset the counters"""
+        self._tiles.clear()
+        self.rows = self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def stats(self):
+        """return a dict of the counters"""
+        return dict(hits=self.hits, misses=self.misses, tiles=len(self),
+                    rows=self.rows, evictions=self.evictions)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%i" % kv
+                                       for kv in sorted(self.stats().items())))
+
+    def tile(self, key, fetch):
+        """
+        return the rows for `key` (table, chrom, tile) calling `fetch` to
+        get them from the database if they are not cached.
+        """
+        try:
+            rows = self._tiles.pop(key)
+        except KeyError:
+            self.misses += 1
+            if self.backing is not None:
+                rows = self.backing.tile(key, fetch)
+            else:
+                rows = list(fetch())
+            self.rows += len(rows)
+            while self.rows > self.max_rows and self._tiles:
+                _, old = self._tiles.popitem(last=False)
+                self.rows -= len(old)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        # (re-)insert as the most recently used
+        self._tiles[key] = rows
+        return rows
+
+
+class LocalTileCache(_Tiles):
+    """
+    Read-through cache that copies tiles from the remote database into a
+    local one as they are used. Tables are created locally (as in
+    `cruzdb.mirror`) the first time they are used and the table
+    `cruzdb_tiles` records which tiles of each chromosome are held so later
+    sessions use them too. A cache should hold tiles from only one
+    database.
+
+    Parameters
+    ----------
+
+    genome : Genome
+        the (remote) Genome that tiles are copied from
+
+    url : str
+        dburl of the local database, e.g. "sqlite:///cache.db"
+
+    Attributes
+    ----------
+
+    hits, misses : int
+        number of tiles that were (or were not) found in the local database
+    """
+
+    def __init__(self, genome, url):
+        from sqlalchemy import create_engine, MetaData, Table, Column, \
+                Integer, String, PrimaryKeyConstraint
+        self.genome, self.url = genome, url
+        self.engine = create_engine(url)
+        self._tiles_table = Table("cruzdb_tiles", MetaData(),
+                                  Column("db", String(64)),
+                                  Column("tbl", String(64)),
+                                  Column("chrom", String(64)),
+                                  Column("tile", Integer),
+                                  PrimaryKeyConstraint("tbl", "chrom", "tile"))
+        self._tiles_table.create(self.engine, checkfirst=True)
+        dbs = [r[0] for r in self.engine.execute(
+                    self._tiles_table.select().with_only_columns(
+                        [self._tiles_table.c.db]).distinct())]
+        if dbs and dbs != [genome.db]:
+            raise ValueError("%s holds tiles from %s, not %s" % (url,
+                             ", ".join(dbs), genome.db))
+        self._held = {}
+        self._local_tables = {}
+        self._local = None
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """return a dict of the counters"""
+        return dict(hits=self.hits, misses=self.misses)
+
+    def __repr__(self):
+        return "%s(%r, hits=%i, misses=%i)" % (self.__class__.__name__,
+                                    self.url, self.hits, self.misses)
+
+    def _held_tiles(self, table, chrom):
+        """the set of tiles of `chrom` that are in the local `table`"""
+        key = (table, chrom)
+        if not key in self._held:
+            t = self._tiles_table
+            self._held[key] = set(r[0] for r in self.engine.execute(
+                t.select().with_only_columns([t.c.tile]).where(
+                    (t.c.tbl == table) & (t.c.chrom == chrom))))
+        return self._held[key]
+
+    def _local_table(self, table):
+        """the local copy of `table`, created if needed"""
+        if not table in self._local_tables:
+            from sqlalchemy import MetaData, Table
+            from .mirror import portable_columns
+            # reflected again (as in `cruzdb.mirror.set_table`) so the
+            # genome's own table isn't changed.
+            tbl = Table(table, MetaData(), autoload=True,
+                        autoload_with=self.genome.bind)
+            for i, idx in enumerate(tbl.indexes):
+                idx.name = table + "." + idx.name + "_ix" + str(i)
+            portable_columns(tbl, self.url)
+            tbl.create(self.engine, checkfirst=True)
+            self._local_tables[table] = tbl
+        return self._local_tables[table]
+
+    @property
+    def local(self):
+        """a Genome for the local database"""
+        if self._local is None:
+            from . import Genome
+            self._local = Genome(self.url)
+        return self._local
+
+    def tile(self, key, fetch):
+        """
+        return the rows for `key` (table, chrom, tile) from the local
+        database, first copying them with `fetch` if they are not held.
+        """
+        table, chrom, t = key
+        held = self._held_tiles(table, chrom)
+        if t in held:
+            self.hits += 1
+            return self.local._overlapping(table, chrom, t << TILE_SHIFT,
+                                       ((t + 1) << TILE_SHIFT) - 1)
+        self.misses += 1
+        rows = list(fetch())
+        ltable = self._local_table(table)
+        columns = list(ltable.columns.keys())
+        # rows that also overlap a tile that is already held were saved
+        # with that tile. the fetch (like the bins) treats the end as
+        # exclusive so a row ending on the first base of a tile isn't in it.
+        new = [dict((c, getattr(r, c)) for c in columns) for r in rows
+               if not any(u in held for u in range(r.start >> TILE_SHIFT,
+                                (max(r.start, r.end - 1) >> TILE_SHIFT) + 1))]
+        with self.engine.begin() as conn:
+            if new:
+                conn.execute(ltable.insert(), new)
+            conn.execute(self._tiles_table.insert(), dict(db=self.genome.db,
+                                            tbl=table, chrom=chrom, tile=t))
+        held.add(t)
+        if new and self._local is not None:
+            self._local._forget(table)
+        return rows
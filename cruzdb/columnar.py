@@ -0,0 +1,361 @@
+"""
+A read-only, columnar copy of UCSC tables in a directory. Each table is a
+directory with a NumPy array (.npy) per column for each chromosome, with
+the rows sorted by start. Other columns (names, strands, exonStarts, ...)
+are dictionary-encoded: the array holds int32 codes into a list of the
+distinct values (-1 is NULL).
+
+    <path>/<table>/meta.json
+    <path>/<table>/<column>.dict            distinct values ...
+    <path>/<table>/<column>.dict_offsets.npy    ... and where each starts
+    <path>/<table>/<chrom>/<column>.npy
+    <path>/<table>/<chrom>/_max_end.npy     running maximum of the ends
+
+Tables without chrom and start/end columns (e.g. kgXref) are kept in a
+single, unsorted, `_all` partition and can only be read with `dataframe`.
+
+Write one with `cruzdb.Genome.mirror` and a "columnar:///path" url and
+query it with `ColumnarGenome`. Queries are answered with `searchsorted`
+on the memory-mapped arrays and only the rows that are returned are
+turned into (`cruzdb.models.Record`) objects.
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import sys
+
+import six
+
+from .cache import CachedRows
+
+ALL = "_all"
+
+def _kind(col):
+    """'i'nt, 'f'loat or 'd'ictionary-encoded for a sqlalchemy column"""
+    import sqlalchemy
+    if isinstance(col.type, sqlalchemy.Integer):
+        return "i"
+    if isinstance(col.type, (sqlalchemy.Float, sqlalchemy.Numeric)):
+        return "f"
+    return "d"
+
+
+class _Dictionary(object):
+    """the distinct values of a dictionary-encoded column"""
+
+    def __init__(self):
+        self.codes, self.values = {}, []
+
+    def code(self, v):
+        if v is None: return -1
+        try:
+            return self.codes[v]
+        except KeyError:
+            self.codes[v] = len(self.values)
+            self.values.append(v)
+            return self.codes[v]
+
+    def save(self, base):
+        import numpy as np
+        is_bytes = bool(self.values) and isinstance(self.values[0], bytes)
+        offsets = [0]
+        with open(base + ".dict", "wb") as fh:
+            for v in self.values:
+                if not isinstance(v, bytes):
+                    v = six.text_type(v).encode("utf-8")
+                fh.write(v)
+                offsets.append(offsets[-1] + len(v))
+        np.save(base + ".dict_offsets.npy", np.asarray(offsets, dtype=np.int64))
+        return is_bytes
+
+    @staticmethod
+    def load(base, is_bytes):
+        """values as an object array with None at the end for code -1"""
+        import numpy as np
+        offsets = np.load(base + ".dict_offsets.npy")
+        with open(base + ".dict", "rb") as fh:
+            data = fh.read()
+        values = np.empty(len(offsets), dtype=object)
+        for i in range(len(offsets) - 1):
+            v = data[offsets[i]:offsets[i + 1]]
+            values[i] = v if is_bytes else v.decode("utf-8")
+        values[-1] = None
+        return values
+
+
+def write_table(path, table, rows, start_col=None, end_col=None, db=None):
+    """
+    write `rows` of the sqlalchemy `table` to a directory under `path`. If
+    `start_col` and `end_col` (names) are given, the rows must be sorted
+    by chrom and then start. An existing copy of the table is replaced.
+    """
+    import numpy as np
+    columns = list(table.columns.keys())
+    kinds = [_kind(c) for c in table.columns]
+    spatial = start_col is not None
+    ichrom = columns.index("chrom") if spatial else None
+    dicts = dict((c, _Dictionary()) for c, k in zip(columns, kinds) if k == "d")
+
+    final = os.path.join(path, table.name)
+    tmp = final + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    chroms = []
+
+    def flush(part, values):
+        pdir = os.path.join(tmp, part)
+        os.mkdir(pdir)
+        for c, k, vals in zip(columns, kinds, values):
+            base = os.path.join(pdir, c)
+            if k == "d":
+                d = dicts[c]
+                np.save(base + ".npy", np.asarray([d.code(v) for v in vals],
+                                                  dtype=np.int32))
+                continue
+            nulls = np.asarray([v is None for v in vals], dtype=bool)
+            if nulls.any():
+                np.save(base + ".null.npy", nulls)
+                vals = [0 if v is None else v for v in vals]
+            np.save(base + ".npy", np.asarray(vals,
+                            dtype=np.int64 if k == "i" else np.float64))
+        n = len(values[0])
+        if spatial:
+            starts = np.asarray(values[columns.index(start_col)], dtype=np.int64)
+            ends = np.asarray(values[columns.index(end_col)], dtype=np.int64)
+            np.save(os.path.join(pdir, "_max_end.npy"),
+                    np.maximum.accumulate(ends))
+            chroms.append([part, n, max(1, int((ends - starts).max()))])
+        else:
+            chroms.append([part, n, None])
+
+    part, values = None, None
+    for row in rows:
+        row = tuple(row)
+        key = row[ichrom] if spatial else ALL
+        if key != part:
+            if part is not None:
+                flush(part, values)
+            if any(c[0] == key for c in chroms):
+                raise ValueError("rows must be sorted by chrom, start")
+            part, values = key, [[] for c in columns]
+        for vals, v in zip(values, row):
+            vals.append(v)
+    if part is not None:
+        flush(part, values)
+
+    meta = dict(version=1, table=table.name, db=db, columns=columns,
+                kinds=kinds, chroms=chroms, start=start_col, end=end_col,
+                bytes=dict((c, d.save(os.path.join(tmp, c)))
+                           for c, d in dicts.items()))
+    with open(os.path.join(tmp, "meta.json"), "w") as fh:
+        json.dump(meta, fh)
+    if os.path.exists(final):
+        shutil.rmtree(final)
+    os.rename(tmp, final)
+    return sum(c[1] for c in chroms)
+
+
+class ColumnarTable(object):
+    """
+    a table written by `write_table`. Arrays are memory-mapped as they are
+    needed.
+    """
+
+    def __init__(self, path):
+        from .models import Record
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fh:
+            self.meta = json.load(fh)
+        self.name, self.columns = self.meta["table"], self.meta["columns"]
+        self.kinds = dict(zip(self.columns, self.meta["kinds"]))
+        self.chroms = [c[0] for c in self.meta["chroms"]]
+        self.record = Record.for_table(self.name, self.columns, self.meta["db"])
+        self._arrays, self._dicts = {}, {}
+
+    @property
+    def spatial(self):
+        return self.meta["start"] is not None
+
+    def __len__(self):
+        return sum(c[1] for c in self.meta["chroms"])
+
+    def array(self, chrom, column):
+        """the (memory-mapped) array of `column` for `chrom`"""
+        import numpy as np
+        key = (chrom, column)
+        if not key in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, chrom,
+                                        column + ".npy"), mmap_mode="r")
+        return self._arrays[key]
+
+    def _values(self, chrom, column, idx):
+        """python values of `column` for the rows `idx` of `chrom`"""
+        import numpy as np
+        arr = self.array(chrom, column)[idx]
+        if self.kinds[column] == "d":
+            if not column in self._dicts:
+                self._dicts[column] = _Dictionary.load(os.path.join(self.path,
+                                        column), self.meta["bytes"][column])
+            return self._dicts[column][arr].tolist()
+        values = arr.tolist()
+        null = os.path.join(self.path, chrom, column + ".null.npy")
+        if os.path.exists(null):
+            for i in np.flatnonzero(np.load(null, mmap_mode="r")[idx]):
+                values[i] = None
+        return values
+
+    def rows(self, chrom, idx):
+        """Records for the rows `idx` (an array of positions) of `chrom`"""
+        if len(idx) == 0: return []
+        cols = [self._values(chrom, c, idx) for c in self.columns]
+        return [self.record(vals) for vals in zip(*cols)]
+
+    def _check_spatial(self):
+        if not self.spatial:
+            raise ValueError("%s has no start and end columns" % self.name)
+
+    def overlapping(self, chrom, start, end):
+        """positions of the rows that overlap `start`, `end` (inclusive)"""
+        import numpy as np
+        self._check_spatial()
+        if not chrom in self.chroms: return np.zeros(0, dtype=np.int64)
+        max_end = self.array(chrom, "_max_end")
+        lo = np.searchsorted(max_end, start, "left")
+        hi = np.searchsorted(self.array(chrom, self.meta["start"]), end, "right")
+        ends = self.array(chrom, self.meta["end"])
+        return lo + np.flatnonzero(ends[lo:hi] >= start)
+
+    def nearest(self, chrom, start, end, k=1):
+        """positions of the k nearest rows (and any ties) sorted by distance"""
+        import numpy as np
+        self._check_spatial()
+        if not chrom in self.chroms: return np.zeros(0, dtype=np.int64)
+        starts = self.array(chrom, self.meta["start"])
+        ends = self.array(chrom, self.meta["end"])
+        # everything from hi on starts after the query; the kth of those
+        # bounds the distance to anything that can be in the result.
+        hi = np.searchsorted(starts, end, "right")
+        last = min(hi + k, len(starts))
+        if last - hi == k:
+            limit = starts[last - 1] - end
+            last = np.searchsorted(starts, end + limit, "right")
+            lo = np.searchsorted(self.array(chrom, "_max_end"), start - limit,
+                                 "left")
+        else:
+            lo = 0
+        idx = np.arange(lo, last)
+        dist = np.maximum(0, np.maximum(starts[lo:last] - end,
+                                        start - ends[lo:last]))
+        order = np.argsort(dist, kind="mergesort")
+        if len(order) > k:
+            order = order[dist[order] <= dist[order[k - 1]]]
+        return idx[order]
+
+
+class ColumnarGenome(object):
+    """
+    read-only access to the tables in a directory written by
+    `cruzdb.Genome.mirror(tables, "columnar:///path")`. Supports
+    `bin_query`, `knearest` and `dataframe` like a `cruzdb.Genome`; rows
+    are `cruzdb.models.Record`s.
+
+    Parameters
+    ----------
+
+    path : str
+        the directory (or a "columnar:///path" url)
+    """
+
+    def __init__(self, path):
+        if path.startswith("columnar://"):
+            path = path[len("columnar://"):]
+        self.path = path
+        self._tables = {}
+
+    @property
+    def tables(self):
+        return sorted(d for d in os.listdir(self.path) if os.path.exists(
+                        os.path.join(self.path, d, "meta.json")))
+
+    def table(self, table):
+        """the ColumnarTable for `table`"""
+        if not table in self._tables:
+            path = os.path.join(self.path, table)
+            if not os.path.exists(os.path.join(path, "meta.json")):
+                raise AttributeError("no table %s in %s" % (table, self.path))
+            self._tables[table] = ColumnarTable(path)
+        return self._tables[table]
+
+    def __getattr__(self, table):
+        if table.startswith("_"):
+            raise AttributeError(table)
+        return self.table(table)
+
+    def bin_query(self, table, chrom, start, end):
+        """the rows of `table` that overlap `start`, `end` on `chrom`"""
+        t = self.table(table)
+        return CachedRows(t.rows(chrom, t.overlapping(chrom, start, end)))
+
+    def knearest(self, table, chrom_or_feat, start=None, end=None, k=1):
+        """
+        the k nearest rows of `table` (along with any that tie the kth) to
+        a feature or to `chrom`, `start`, `end`; see `cruzdb.Genome.knearest`
+        """
+        if start is None:
+            chrom, start, end = (chrom_or_feat.chrom, chrom_or_feat.start,
+                                 chrom_or_feat.end)
+        else:
+            chrom = chrom_or_feat
+        t = self.table(table)
+        return t.rows(chrom, t.nearest(chrom, int(start), int(end), k))
+
+    def dataframe(self, table):
+        """a pandas DataFrame of `table`"""
+        import numpy as np
+        from pandas import DataFrame, concat
+        t = self.table(table)
+        frames = []
+        for chrom in t.chroms:
+            idx = np.arange(len(t.array(chrom, t.columns[0])))
+            frames.append(DataFrame(dict((c, t._values(chrom, c, idx))
+                                         for c in t.columns), columns=t.columns))
+        if not frames:
+            return DataFrame(columns=t.columns)
+        return concat(frames, ignore_index=True)
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.path)
+
+
+def mirror_columnar(genome, tables, path, regions=None):
+    """
+    write `tables` (limited to `regions` as in `cruzdb.mirror.mirror`) from
+    `genome` to the directory `path` and return a ColumnarGenome for it.
+    """
+    from . import _start_end_columns
+    from .mirror import _region_filter
+    import sqlalchemy
+    if path.startswith("columnar://"):
+        path = path[len("columnar://"):]
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for table_name in tables:
+        table = getattr(genome, table_name)._table
+        where = None if regions is None else \
+                _region_filter(genome, table, regions, tables)
+        q = sqlalchemy.select(table.columns)
+        if where is not None:
+            q = q.where(where)
+        start_col = end_col = None
+        if "chrom" in table.c and ("txStart" in table.c or
+                                   "chromStart" in table.c):
+            cstart, cend = _start_end_columns(table)
+            start_col, end_col = cstart.name, cend.name
+            q = q.order_by(table.c.chrom, cstart)
+        res = genome.engine.execute(q.execution_options(stream_results=True))
+        n = write_table(path, table, res, start_col, end_col,
+                        db=genome.engine.url.database)
+        print('Mirrored %s (%i rows)' % (table_name, n), file=sys.stderr)
+    return ColumnarGenome(path)
@@ -1,5 +1,12 @@
 import operator
 import collections
+from bisect import bisect_left
+from array import array
+import heapq
+import json
+import mmap
+import struct
+from six.moves import cPickle as pickle
 
 class Feature(object):
     """\
@@ -33,6 +40,12 @@ class Feature(object):
         fstr += ")"
         return fstr
 
+# first and last bytes of an index written by write_index
+INDEX_MAGIC = b"CRUZIDX1"
+
+# size of the first window searched by Intersecter.left
+LEFT_WINDOW = 2000
+
 def binsearch_left_start(intervals, x, lo, hi):
     while lo < hi:
         mid = (lo + hi)//2
@@ -45,17 +58,81 @@ def binsearch_left_start(intervals, x, lo, hi):
 # could be inserted to maintain order in the list intervals
 def binsearch_right_end(intervals, x, lo, hi):
     while lo < hi:
-        mid = (lo + hi)/2
+        mid = (lo + hi)//2
         f = intervals[mid]
         if x < f.start: hi = mid
         else: lo = mid + 1
     return lo
 
+class NCList(object):
+    """\
+    Nested containment list (Alekseyenko and Lee, 2007) over a list of
+    intervals sorted by start. Intervals that are contained in another
+    interval are moved to a sublist of the containing interval so that in
+    each list both starts and ends are sorted. A query is then a binary
+    search on the ends followed by a scan that only touches hits, and
+    a single very long interval does not slow down every query as it does
+    with the max_len search in `Intersecter`.
+
+    `find` returns the (sorted) indexes of the overlapping intervals.
+
+    >>> from intersecter import NCList, Feature
+    >>> ncl = NCList([Feature(0, 100), Feature(3, 7), Feature(20, 40),
+    ...               Feature(30, 35), Feature(60, 90), Feature(95, 120)])
+    >>> ncl.find(33, 34)
+    [0, 2, 3]
+    >>> ncl.find(101, 110)
+    [5]
+    """
+    __slots__ = ("starts", "ends", "members", "sublists")
+
+    def __init__(self, intervals):
+        # containers must come before the intervals they contain.
+        order = sorted(range(len(intervals)), key=lambda i:
+                       (intervals[i].start, -intervals[i].end))
+        top, children, stack = [], {}, []
+        for i in order:
+            iv = intervals[i]
+            while stack and intervals[stack[-1]].end < iv.end:
+                stack.pop()
+            if stack:
+                children.setdefault(stack[-1], []).append(i)
+            else:
+                top.append(i)
+            stack.append(i)
+
+        def sublist(members):
+            return ([intervals[i].start for i in members],
+                    [intervals[i].end for i in members], members)
+
+        self.starts, self.ends, self.members = sublist(top)
+        self.sublists = dict((i, sublist(m)) for i, m in children.items())
+
+    def find(self, start, end):
+        res = []
+        todo = [(self.starts, self.ends, self.members)]
+        sublists = self.sublists
+        while todo:
+            starts, ends, members = todo.pop()
+            # the ends are sorted, so skip everything that ends before start.
+            i = bisect_left(ends, start)
+            n = len(starts)
+            while i < n and starts[i] <= end:
+                res.append(members[i])
+                if members[i] in sublists:
+                    todo.append(sublists[members[i]])
+                i += 1
+        res.sort()
+        return res
+
 class Intersecter(object):
     """\
     Data structure for performing intersect and neighbor queries on a
     set of intervals. Algorithm uses simple binary search along with
     knowledge of the longest interval to perform efficient queries.
+    If the lengths of the intervals vary widely (a few very long intervals
+    make the max_len search scan most of a chromosome), use
+    index="nclist" to search a nested containment list instead.
 
     Usage
     =====
@@ -90,6 +167,11 @@ class Intersecter(object):
     >>> intersecter.find(100, 200)
     []
 
+    the same queries can use a nested containment list:
+
+    >>> Intersecter(features, index="nclist").find(11, 100)
+    [Feature(3, 40, strand=-1), Feature(13, 50, strand=1)]
+
     left/right
     ++++++++++
     the left method finds features that are strictly to the left of
@@ -123,7 +205,12 @@ class Intersecter(object):
     [Feature(0, 10, strand=-1)]
 
     >>> intersecter.knearest(Feature(1, 2), k=2)
-    [Feature(0, 10, strand=-1), Feature(3, 40, strand=-1), Feature(3, 7, strand=1)]
+    [Feature(0, 10, strand=-1), Feature(3, 7, strand=1), Feature(3, 40, strand=-1)]
+
+    left and upstream search further away as needed:
+
+    >>> intersecter.left(Feature(100000, 100001), n=2)
+    [Feature(13, 50, strand=1), Feature(3, 40, strand=-1)]
 
     """
 
@@ -133,7 +220,8 @@ class Intersecter(object):
 
     # ---- Basic API --------------------------------------------------
 
-    def __init__(self, intervals):
+    def __init__(self, intervals, index="max_len"):
+        assert index in ("max_len", "nclist")
         self.intervals = collections.defaultdict(list)
         self.max_len = {}
 
@@ -143,9 +231,38 @@ class Intersecter(object):
             self.intervals[chrom].sort(key=operator.attrgetter('start'))
             self.max_len[chrom] = max(1, max([i.end - i.start for i in self.intervals[chrom]]))
 
+        self.index = index
+        if index == "nclist":
+            self.nclists = dict((chrom, NCList(ivs)) for chrom, ivs in
+                                self.intervals.items())
+
+    def chrom_intervals(self, chrom, start=None):
+        """
+        return the intervals on `chrom` in order of start. If `start` is
+        given, some of the intervals that end before `start` are skipped.
+        """
+        intervals = self.intervals.get(chrom, [])
+        if start is None or not intervals: return intervals
+        return intervals[binsearch_left_start(intervals,
+                                start - self.max_len[chrom], 0, len(intervals)):]
+
+    @staticmethod
+    def open(path):
+        """
+        memory-map an index file written by `write_index` (or
+        `cruzdb.Genome.build_index`) and return an ArrayIntersecter over
+        it. Nothing is copied or parsed up front and the file is opened
+        read-only, so many processes can share it through the page cache.
+        The rows are unpickled only as they are returned by queries.
+        """
+        return ArrayIntersecter._open(path)
 
     def find(self, start, end, chrom=None):
         """Return a object of all stored intervals intersecting between (start, end) inclusive."""
+        if self.index == "nclist":
+            if not chrom in self.nclists: return []
+            intervals = self.intervals[chrom]
+            return [intervals[i] for i in self.nclists[chrom].find(start, end)]
         intervals = self.intervals[chrom]
         ilen = len(intervals)
         # NOTE: we only search for starts, since any feature that starts within max_len of
@@ -167,29 +284,20 @@ class Intersecter(object):
         f: a Feature object
         n: the number of features to return
         """
-        intervals = self.intervals[f.chrom]
-        if intervals == []: return []
-
-        iright = binsearch_left_start(intervals, f.start, 0 , len(intervals)) + 1
-        ileft  = binsearch_left_start(intervals, f.start - self.max_len[f.chrom] - 1, 0, 0)
-
-        results = sorted((distance(other, f), other) for other in intervals[ileft:iright] if other.end < f.start and distance(f, other) != 0)
-        if len(results) == n:
-            return [r[1] for r in results]
-
-        # have to do some extra work here since intervals are sorted
-        # by starts, and we dont know which end may be around...
-        # in this case, we got some extras, just return as many as
-        # needed once we see a gap in distances.
-        for i in range(n, len(results)):
-            if results[i - 1][0] != results[i][0]:
-                return [r[1] for r in results[:i]]
-
-        if ileft == 0:
-            return [r[1] for r in results]
-
-        # here, didn't get enough, so move left and try again. 
-        1/0
+        if not f.chrom in self.max_len or f.start < 1: return []
+
+        # intervals are sorted by start, not by end so search windows of
+        # increasing size to the left. any feature ending in the window is
+        # closer than one that isn't so once there are n, they are the
+        # nearest (and any ties are also in the window).
+        width = LEFT_WINDOW
+        while True:
+            wstart = max(0, f.start - width)
+            results = [other for other in self.find(wstart, f.start - 1, f.chrom)
+                            if other.end < f.start]
+            if len(results) >= n or wstart == 0:
+                return nearest(f, results, n)
+            width *= 4
 
     def right(self, f, n=1):
         """return the nearest n features strictly to the right of a Feature f.
@@ -200,19 +308,12 @@ class Intersecter(object):
         """
         intervals = self.intervals[f.chrom]
         ilen = len(intervals)
+        # intervals are sorted by start so the nearest are next in the list.
         iright = binsearch_right_end(intervals, f.end, 0, ilen)
-        results = []
-
-        while iright < ilen:
-            i = len(results)
-            if i > n:
-                if distance(f, results[i - 1]) != distance(f, results[i - 2]):
-                    return results[:i - 1]
-            other = intervals[iright]
-            iright += 1
-            if distance(other, f) == 0: continue
-            results.append(other)
-        return results
+        iend = min(iright + n, ilen)
+        while iend < ilen and intervals[iend].start == intervals[iend - 1].start:
+            iend += 1
+        return intervals[iright:iend]
 
 
     def upstream(self, f, n=1):
@@ -252,20 +353,400 @@ class Intersecter(object):
         else:
             f = f_or_start
 
-        DIST = 2000
-        feats = filter_feats(self.find(f.start - DIST, f.end + DIST, chrom=f.chrom), f, k)
+        # overlapping features have distance 0, so only look to the sides
+        # if there are fewer than k of them.
+        feats = self.find(f.start, f.end, chrom=f.chrom)
         if len(feats) >= k:
             return feats
 
-        nfeats = k - len(feats)
-        fleft = Feature(f.start - DIST, f.start, chrom=f.chrom)
-        feats.extend(self.left(fleft, n=nfeats))
-
-        fright = Feature(f.end, f.end + DIST, chrom=f.chrom)
-        feats.extend(self.right(fright, n=nfeats))
+        feats.extend(self.left(f, n=k))
+        feats.extend(self.right(f, n=k))
         return filter_feats(feats, f, k)
 
 
+class ArrayIntersecter(Intersecter):
+    """\
+    Intersecter that stores the sorted starts, ends and row-ids of the
+    intervals in NumPy arrays rather than as lists of python objects and
+    uses `searchsorted` in place of the binary searches. This takes a few
+    machine words per interval and allows many queries to be answered at
+    once with `find_many`.
+
+    >>> from intersecter import ArrayIntersecter, Feature
+    >>> features = [Feature(0, 10, chrom="chr1"), Feature(3, 7, chrom="chr1"),
+    ...             Feature(3, 40, chrom="chr1"), Feature(13, 50, chrom="chr2")]
+    >>> ai = ArrayIntersecter(features)
+    >>> ai.find(2, 5, "chr1")
+    [Feature(0, 10, chrom=chr1), Feature(3, 7, chrom=chr1), Feature(3, 40, chrom=chr1)]
+
+    find_many returns CSR-style results: the hits for query i are the row-ids
+    (indexes into the original intervals) in hits[offsets[i]:offsets[i + 1]]
+
+    >>> offsets, hits = ai.find_many(["chr1", "chr2", "chr3"], [11, 11, 0], [100, 100, 10])
+    >>> offsets.tolist(), hits.tolist()
+    ([0, 1, 2, 2], [2, 3])
+
+    If the intervals are only needed for their positions, use `from_arrays`
+    and no python object is kept for each interval. `find` then returns the
+    row-ids.
+
+    >>> ai = ArrayIntersecter.from_arrays(["chr1", "chr1"], [5, 20], [10, 30])
+    >>> ai.find(8, 22, "chr1").tolist()
+    [0, 1]
+    """
+
+    def __init__(self, intervals):
+        intervals = list(intervals)
+        self._build([iv.chrom for iv in intervals],
+                    [iv.start for iv in intervals],
+                    [iv.end for iv in intervals])
+        self.features = intervals
+
+    @classmethod
+    def from_arrays(cls, chroms, starts, ends, ids=None, features=None):
+        """
+        create an ArrayIntersecter from sequences of chroms, starts and ends.
+        `ids` defaults to the index of each interval. If `features` is
+        given, it must be indexable by the ids and find will return
+        features rather than ids.
+        """
+        self = cls.__new__(cls)
+        self._build(chroms, starts, ends, ids)
+        self.features = features
+        return self
+
+    def _build(self, chroms, starts, ends, ids=None):
+        import numpy as np
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        ids = np.arange(len(starts), dtype=np.int64) if ids is None \
+                else np.asarray(ids, dtype=np.int64)
+
+        names, codes = np.unique(chroms, return_inverse=True)
+        order = np.lexsort((starts, codes))
+        self.starts, self.ends, self.ids = starts[order], ends[order], ids[order]
+
+        # each chromosome is a contiguous (lo, hi) slice of the arrays.
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        self.bounds, self.max_len = {}, {}
+        # running maximum of the ends, so everything before the first
+        # max_end >= start also ends before start.
+        self.max_end = self.ends.copy()
+        for i, chrom in enumerate(names):
+            lo, hi = int(bounds[i]), int(bounds[i + 1])
+            self.bounds[str(chrom)] = (lo, hi)
+            self.max_len[str(chrom)] = max(1, int((self.ends[lo:hi] -
+                                                   self.starts[lo:hi]).max()))
+            np.maximum.accumulate(self.max_end[lo:hi], out=self.max_end[lo:hi])
+
+    @classmethod
+    def _open(cls, path):
+        import numpy as np
+        with open(path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:8] != INDEX_MAGIC or mm[-8:] != INDEX_MAGIC:
+            raise ValueError("%s is not a cruzdb index" % path)
+        hlen = struct.unpack('<Q', mm[-16:-8])[0]
+        header = json.loads(mm[len(mm) - 16 - hlen:len(mm) - 16].decode('utf-8'))
+
+        def column(name):
+            offset, count = header['arrays'][name]
+            return np.frombuffer(mm, dtype='<i8', count=count, offset=offset)
+
+        self = cls.__new__(cls)
+        self.header = header
+        self.starts, self.ends = column('starts'), column('ends')
+        self.ids, self.max_end = column('ids'), column('max_end')
+        self.bounds, self.max_len = {}, {}
+        for chrom, lo, hi, max_len in header['chroms']:
+            self.bounds[chrom] = (lo, hi)
+            self.max_len[chrom] = max_len
+        record = None
+        if header.get('columns'):
+            from cruzdb.models import Record
+            record = Record.for_table(header.get('table'), header['columns'],
+                                      header.get('db'))
+        self.features = _IndexRows(mm, header['arrays']['rows'][0],
+                                   column('row_offsets'), record)
+        return self
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def intervals(self):
+        """
+        dict of chrom => list of features sorted by start. This is created
+        on first use so that the methods inherited from Intersecter work.
+        """
+        try:
+            return self._intervals
+        except AttributeError:
+            pass
+        if self.features is None:
+            raise ValueError("ArrayIntersecter was created without features")
+        self._intervals = collections.defaultdict(list)
+        for chrom, (lo, hi) in self.bounds.items():
+            self._intervals[chrom] = [self.features[i] for i in self.ids[lo:hi]]
+        return self._intervals
+
+    def chrom_intervals(self, chrom, start=None):
+        """
+        iterate over the intervals on `chrom` in order of start. If `start`
+        is given, the intervals before the first that ends at or after
+        `start` are skipped.
+        """
+        import numpy as np
+        if not chrom in self.bounds: return
+        lo, hi = self.bounds[chrom]
+        if start is not None:
+            lo += np.searchsorted(self.max_end[lo:hi], start, 'left')
+        for i in self.ids[lo:hi]:
+            yield i if self.features is None else self.features[i]
+
+    def _rows(self, pos):
+        """the features (or row-ids) at positions `pos` of the arrays"""
+        ids = self.ids[pos]
+        if self.features is None: return ids
+        return [self.features[i] for i in ids]
+
+    def _find_pos(self, start, end, chrom):
+        """positions in the arrays of the intervals that find returns"""
+        import numpy as np
+        if not chrom in self.bounds: return np.zeros(0, dtype=np.int64)
+        lo, hi = self.bounds[chrom]
+        # this is at least as tight as subtracting max_len (see
+        # Intersecter.find) from the start.
+        ileft = np.searchsorted(self.max_end[lo:hi], start, 'left')
+        iright = np.searchsorted(self.starts[lo:hi], end, 'right')
+        hits = np.flatnonzero(self.ends[lo + ileft:lo + iright] >= start)
+        return lo + ileft + hits
+
+    def find_ids(self, start, end, chrom=None):
+        """
+        Return a numpy array of the row-ids of all stored intervals
+        intersecting between (start, end) inclusive.
+        """
+        return self.ids[self._find_pos(start, end, chrom)]
+
+    def find(self, start, end, chrom=None):
+        """
+        Return a list of all stored intervals intersecting between (start,
+        end) inclusive. These are row-ids if no features were given.
+        """
+        return self._rows(self._find_pos(start, end, chrom))
+
+    def _left_pos(self, f, n):
+        """positions of the intervals that left returns"""
+        import numpy as np
+        if not f.chrom in self.bounds or f.start < 1 or n < 1:
+            return np.zeros(0, dtype=np.int64)
+        width = LEFT_WINDOW
+        while True:
+            wstart = max(0, f.start - width)
+            pos = self._find_pos(wstart, f.start - 1, f.chrom)
+            pos = pos[self.ends[pos] < f.start]
+            if len(pos) >= n or wstart == 0:
+                break
+            width *= 4
+        if len(pos) > n:
+            # the n largest ends and any ties with the nth.
+            ends = self.ends[pos]
+            pos = pos[ends >= np.partition(ends, len(ends) - n)[len(ends) - n]]
+        return pos
+
+    def _right_pos(self, f, n):
+        """positions of the intervals that right returns"""
+        import numpy as np
+        if not f.chrom in self.bounds or n < 1:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self.bounds[f.chrom]
+        starts = self.starts[lo:hi]
+        iright = lo + np.searchsorted(starts, f.end, 'right')
+        iend = min(iright + n, hi)
+        if iright < iend < hi:
+            # include ties with the nth
+            iend = lo + np.searchsorted(starts, self.starts[iend - 1], 'right')
+        return np.arange(iright, iend, dtype=np.int64)
+
+    def left(self, f, n=1):
+        """return the nearest n features strictly to the left of a Feature f.
+        These are row-ids if no features were given.
+        """
+        import numpy as np
+        pos = self._left_pos(f, n)
+        return self._rows(pos[np.argsort(-self.ends[pos], kind="mergesort")]
+                          if len(pos) else pos)
+
+    def right(self, f, n=1):
+        """return the nearest n features strictly to the right of a Feature f.
+        These are row-ids if no features were given.
+        """
+        return self._rows(self._right_pos(f, n))
+
+    def knearest(self, f_or_start, end=None, chrom=None, k=1):
+        """return the k nearest neighbors (and any ties) to the given feature
+        sorted by distance. These are row-ids if no features were given.
+        """
+        import numpy as np
+        if end is not None:
+            f = Feature(f_or_start, end, chrom=chrom)
+        else:
+            f = f_or_start
+        pos = self._find_pos(f.start, f.end, f.chrom)
+        if len(pos) >= k:
+            return self._rows(pos)
+        pos = np.concatenate([pos, self._left_pos(f, k), self._right_pos(f, k)])
+        dists = np.maximum(0, np.maximum(f.start - self.ends[pos],
+                                         self.starts[pos] - f.end))
+        order = np.argsort(dists, kind="mergesort")
+        if len(order) > k:
+            order = order[dists[order] <= dists[order[k - 1]]]
+        return self._rows(pos[order])
+
+    def find_many(self, chroms, starts, ends, chunk=200000):
+        """
+        find the intervals intersecting each (chrom, start, end) query.
+
+        Returns (offsets, hits) where hits is an array of row-ids and the
+        hits for query i are hits[offsets[i]:offsets[i + 1]].
+
+        Queries are processed `chunk` at a time to bound memory use.
+        """
+        import numpy as np
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        n = len(starts)
+
+        counts = np.zeros(n, dtype=np.int64)
+        hits = []
+        for c0 in range(0, n, chunk):
+            c1 = min(n, c0 + chunk)
+            cstarts, cends = starts[c0:c1], ends[c0:c1]
+            lo = np.zeros(c1 - c0, dtype=np.int64)
+            hi = np.zeros(c1 - c0, dtype=np.int64)
+            names, codes = np.unique(chroms[c0:c1], return_inverse=True)
+            for i, chrom in enumerate(names):
+                if not str(chrom) in self.bounds: continue
+                clo, chi = self.bounds[str(chrom)]
+                sel = codes == i
+                lo[sel] = clo + np.searchsorted(self.max_end[clo:chi],
+                                                cstarts[sel], 'left')
+                hi[sel] = clo + np.searchsorted(self.starts[clo:chi],
+                                                cends[sel], 'right')
+
+            # expand each query to its candidate positions [lo, hi) ...
+            ccounts = hi - lo
+            qidx = np.repeat(np.arange(c1 - c0), ccounts)
+            pos = np.arange(ccounts.sum()) + np.repeat(lo - (np.cumsum(ccounts)
+                                                     - ccounts), ccounts)
+            # ... and keep those that actually overlap.
+            keep = self.ends[pos] >= cstarts[qidx]
+            qidx, pos = qidx[keep], pos[keep]
+            counts[c0:c1] = np.bincount(qidx, minlength=c1 - c0)
+            hits.append(self.ids[pos])
+
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        hits = np.concatenate(hits) if hits else np.zeros(0, dtype=np.int64)
+        return offsets, hits
+
+
+class _IndexRows(object):
+    """
+    sequence of the rows in a memory-mapped index. Each row is unpickled
+    (and turned into a `record` if given) when it's accessed.
+    """
+    def __init__(self, mm, offset, row_offsets, record=None):
+        self.mm, self.offset = mm, offset
+        self.row_offsets, self.record = row_offsets, record
+
+    def __len__(self):
+        return len(self.row_offsets) - 1
+
+    def __getitem__(self, i):
+        a, b = self.row_offsets[i], self.row_offsets[i + 1]
+        row = pickle.loads(self.mm[self.offset + a:self.offset + b])
+        return row if self.record is None else self.record(row)
+
+
+def write_index(path, rows, chrom_col, start_col, end_col, columns=None, **meta):
+    """
+    write an interval index that can be memory-mapped by `Intersecter.open`.
+
+    The file holds the pickled `rows` followed by int64 arrays of the row
+    offsets, starts, ends, row-ids and running maximum end, and then a JSON
+    header with the per-chromosome (lo, hi, max_len) slices, the `columns`
+    and anything in `meta` (e.g. table and db).
+
+    Parameters
+    ----------
+
+    path : str
+        file to write
+
+    rows : iterable
+        tuples sorted by chrom and then start
+
+    chrom_col, start_col, end_col : int
+        index of the chrom, start and end in each row
+
+    columns : list
+        names of the columns in each row. If given, `Intersecter.open`
+        returns `cruzdb.models.Record`s rather than tuples.
+    """
+    import numpy as np
+    chroms = []
+    starts, ends, offsets = array('q'), array('q'), array('q', [0])
+    with open(path, 'wb') as fh:
+        fh.write(INDEX_MAGIC)
+        pos = 0
+        for i, row in enumerate(rows):
+            row = tuple(row)
+            chrom, start = row[chrom_col], row[start_col]
+            if not chroms or chroms[-1][0] != chrom:
+                if any(c[0] == chrom for c in chroms):
+                    raise ValueError("rows must be sorted by chrom, start")
+                if chroms: chroms[-1][2] = i
+                chroms.append([chrom, i, None, 1])
+            elif start < starts[-1]:
+                raise ValueError("rows must be sorted by chrom, start")
+            starts.append(start)
+            ends.append(row[end_col])
+            chroms[-1][3] = max(chroms[-1][3], row[end_col] - start)
+            blob = pickle.dumps(row, 2)
+            fh.write(blob)
+            pos += len(blob)
+            offsets.append(pos)
+        n = len(starts)
+        if chroms: chroms[-1][2] = n
+
+        starts = np.asarray(starts, dtype='<i8')
+        ends = np.asarray(ends, dtype='<i8')
+        max_end = ends.copy()
+        for chrom, lo, hi, max_len in chroms:
+            np.maximum.accumulate(max_end[lo:hi], out=max_end[lo:hi])
+
+        arrays = {}
+        fh.write(b"\0" * (-fh.tell() % 8))
+        for name, arr in (('row_offsets', np.asarray(offsets, dtype='<i8')),
+                          ('starts', starts), ('ends', ends),
+                          ('ids', np.arange(n, dtype='<i8')),
+                          ('max_end', max_end)):
+            arrays[name] = (fh.tell(), len(arr))
+            fh.write(arr.tobytes())
+        arrays['rows'] = (len(INDEX_MAGIC), pos)
+
+        header = dict(meta, version=1, n=n, chroms=chroms, arrays=arrays,
+                      columns=list(columns) if columns else None)
+        header = json.dumps(header).encode('utf-8')
+        fh.write(header)
+        fh.write(struct.pack('<Q', len(header)))
+        fh.write(INDEX_MAGIC)
+
+
 def distance(f1, f2):
     """\
     Distance between 2 features. The integer result is always positive or zero.
@@ -283,12 +764,27 @@ def distance(f1, f2):
     if f2.end < f1.start: return f1.start - f2.end
     return 0
 
+def nearest(f, intervals, k):
+    """\
+    Return the k intervals nearest to f along with any that tie the kth.
+    Uses a heap of size k rather than sorting all of the intervals.
+    The result is sorted by distance.
+
+    >>> from intersecter import Feature, nearest
+    >>> nearest(Feature(10, 20), [Feature(0, 5), Feature(22, 30),
+    ...                           Feature(25, 30), Feature(1, 8)], 2)
+    [Feature(22, 30), Feature(1, 8)]
+    """
+    if k < 1: return []
+    dists = [(distance(f, iv), i) for i, iv in enumerate(intervals)]
+    best = heapq.nsmallest(k, dists)
+    if len(best) == k:
+        kth = best[-1][0]
+        best.extend(d for d in dists if d[0] == kth and d[1] > best[-1][1])
+    return [intervals[i] for d, i in best]
+
 def filter_feats(intervals, f, k):
-    feats = sorted((distance(f, iv), iv) for iv in intervals if iv is not None)
-    kk = k
-    while kk < len(feats) and feats[k - 1][0] == feats[kk][0]:
-        kk += 1
-    return [f[1] for f in feats[:kk]]
+    return nearest(f, [iv for iv in intervals if iv is not None], k)
 
 if __name__ == "__main__":
     import doctest
@@ -2,15 +2,21 @@
 
 from __future__ import print_function
 
-from sqlalchemy import create_engine, Table, select, Enum, Column, MetaData
+from sqlalchemy import create_engine, Table, select, Enum, Column, MetaData, \
+        and_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.mysql import LONGBLOB, ENUM
+from sqlalchemy.dialects.mysql import LONGBLOB, ENUM, TINYBLOB, MEDIUMBLOB, \
+        TINYINT, MEDIUMINT, DOUBLE, TINYTEXT, MEDIUMTEXT, LONGTEXT
 from sqlalchemy.dialects.postgresql import ENUM as PG_ENUM
 from sqlalchemy.types import VARCHAR
 import sqlalchemy
 import sys
 import os
+import hashlib
+import struct
+from decimal import Decimal
+import six
 
 
 def make_session(connection_string):
@@ -25,30 +31,23 @@ def make_session(connection_string):
     return Session(), engine
 
 def page_query(q, session, limit=8000):
-    #if q.count() < 80000:
-    #    for rn q.all()
-    offset = 0
+    """
+    yield the rows of the select `q` with a server-side cursor (paging with
+    OFFSET rescans the skipped rows for every page). When the table is
+    known, `cruzdb.Genome.stream` pages through an index instead.
+    """
+    res = session.execute(q.execution_options(stream_results=True))
     while True:
-        elem = None
-        for elem in session.execute(q.offset(offset).limit(limit)):
-            yield elem
-        offset += limit
-        if elem is None:
-            break
+        rows = res.fetchmany(limit)
+        if not rows: break
+        for row in rows:
+            yield row
 
-def set_table(genome, table, table_name, connection_string, metadata):
+def portable_columns(table, connection_string):
     """
-    alter the table to work between different
-    dialects
+    convert the mysql-specific types of the columns in `table` to ones that
+    work with the database at `connection_string` and return the columns.
     """
-    table = Table(table_name, genome._metadata, autoload=True,
-                    autoload_with=genome.bind, extend_existing=True)
-
-    #print "\t".join([c.name for c in table.columns])
-    # need to prefix the indexes with the table name to avoid collisions
-    for i, idx in enumerate(table.indexes):
-        idx.name = table_name + "." + idx.name + "_ix" + str(i)
-
     cols = []
     for i, col in enumerate(table.columns):
         # convert mysql-specific types to varchar
@@ -64,6 +63,17 @@ def set_table(genome, table, table_name, connection_string, metadata):
                         create_type=True)
                 else:
                     col.type = VARCHAR()
+        elif isinstance(col.type, (TINYBLOB, MEDIUMBLOB)) \
+                and not "mysql" in connection_string:
+            col.type = VARCHAR()
+        elif isinstance(col.type, (TINYINT, MEDIUMINT)) \
+                and not "mysql" in connection_string:
+            col.type = sqlalchemy.Integer()
+        elif isinstance(col.type, DOUBLE) and not "mysql" in connection_string:
+            col.type = sqlalchemy.Float()
+        elif isinstance(col.type, (TINYTEXT, MEDIUMTEXT, LONGTEXT)) \
+                and not "mysql" in connection_string:
+            col.type = sqlalchemy.Text()
         elif str(col.type) == "VARCHAR" \
                 and ("mysql" in connection_string \
                 or "postgres" in connection_string):
@@ -72,59 +82,602 @@ def set_table(genome, table, table_name, connection_string, metadata):
         if not "mysql" in connection_string:
             if str(col.type).lower().startswith("set("):
                 col.type = VARCHAR(15)
+
         cols.append(col)
+    return cols
+
+def set_table(genome, table, table_name, connection_string, metadata):
+    """
+    alter the table to work between different
+    dialects
+    """
+    table = Table(table_name, genome._metadata, autoload=True,
+                    autoload_with=genome.bind, extend_existing=True)
+
+    #print "\t".join([c.name for c in table.columns])
+    # need to prefix the indexes with the table name to avoid collisions
+    for i, idx in enumerate(table.indexes):
+        idx.name = table_name + "." + idx.name + "_ix" + str(i)
+
+    cols = portable_columns(table, connection_string)
 
     table = Table(table_name, genome._metadata, *cols,
             autoload_replace=True, extend_existing=True)
 
     return table
 
-def mirror(genome, tables, connection_string):
+# rows sent to the destination with each insert
+BATCH = 20000
+
+# tables with more rows than this (and a chrom column) are copied in
+# partitions of one chromosome.
+PARTITION_ROWS = 1000000
+
+# used on new sqlite destinations while tables are loaded. if the load is
+# interrupted the partitions that were not recorded are copied again. they
+# could corrupt an existing database so they are never used for one.
+SQLITE_LOAD_PRAGMAS = ("PRAGMA journal_mode = OFF",
+                       "PRAGMA synchronous = OFF",
+                       "PRAGMA cache_size = -200000",
+                       "PRAGMA temp_store = MEMORY")
+
+def _checkpoint_table(dengine):
+    """
+    the table in the destination that records the partitions that have
+    been copied and whether they have been verified
+    """
+    t = Table("cruzdb_mirror", MetaData(),
+              Column("tbl", VARCHAR(64)), Column("part", VARCHAR(255)),
+              Column("nrows", sqlalchemy.BigInteger),
+              Column("checksum", VARCHAR(16)),
+              Column("verified", sqlalchemy.Boolean))
+    t.create(dengine, checkfirst=True)
+    if not "verified" in [c["name"] for c in
+                          sqlalchemy.inspect(dengine).get_columns(t.name)]:
+        # recorded by an older version; those partitions are verified again.
+        dengine.execute("ALTER TABLE cruzdb_mirror ADD COLUMN verified BOOLEAN")
+    return t
+
+def _row_hash(values):
+    """
+    64-bit hash of the values in a row. Values are normalized so a row
+    hashes the same when it's read from the source and from the destination
+    even if the database drivers return different types.
+    """
+    parts = []
+    for v in values:
+        if isinstance(v, six.text_type):
+            v = v.encode("utf-8")
+        elif v is None:
+            v = b"\x00"
+        elif isinstance(v, (float, Decimal)):
+            v = repr(float(v)).encode()
+        elif not isinstance(v, bytes):
+            v = six.text_type(v).encode("utf-8")
+        parts.append(v)
+    parts.append(b"")
+    return struct.unpack("<Q", hashlib.md5(b"\t".join(parts)).digest()[:8])[0]
+
+class _Checksum(object):
+    """order-independent count and checksum of a set of rows"""
+    def __init__(self, rows=()):
+        self.n, self.sum = 0, 0
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        self.sum = (self.sum + _row_hash(row)) & 0xFFFFFFFFFFFFFFFF
+        self.n += 1
+
+    def value(self):
+        return self.n, "%016x" % self.sum
+
+def _partition(table, part, has_chrom):
+    """where clause for a partition of table"""
+    return table.c.chrom == part if has_chrom else sqlalchemy.true()
+
+def _new_sqlite(connection_string):
+    """is `connection_string` a sqlite database that doesn't exist yet?"""
+    url = sqlalchemy.engine.url.make_url(connection_string)
+    if url.get_backend_name() != "sqlite":
+        return False
+    return not url.database or url.database == ":memory:" or \
+            not os.path.exists(url.database) or \
+            os.path.getsize(url.database) == 0
+
+class _Destination(object):
+    """
+    a single connection to the destination that the copying threads take
+    turns to use. Rows are inserted as tuples with the DBAPI executemany.
+    If `new` is True and it's sqlite, SQLITE_LOAD_PRAGMAS are used until it
+    is closed.
+    """
+    def __init__(self, connection_string, new=False):
+        import threading
+        self.lock = threading.Lock()
+        args = {}
+        if connection_string.startswith("sqlite"):
+            # access is serialized by self.lock
+            args["check_same_thread"] = False
+        dengine = create_engine(connection_string, connect_args=args)
+        self.conn = dengine.connect()
+        self.dialect = dengine.dialect
+        self.sqlite = self.dialect.name == "sqlite"
+        self._inserts = {}
+        self._restore = []
+        if self.sqlite and new:
+            for pragma in SQLITE_LOAD_PRAGMAS:
+                name = pragma.split()[1]
+                self._restore.append("PRAGMA %s = %s" % (name,
+                        self.conn.execute("PRAGMA %s" % name).scalar()))
+                self.conn.execute(pragma)
+
+    def insert(self, table, rows):
+        """insert a list of tuples in the order of table.columns"""
+        if not table.name in self._inserts:
+            compiled = table.insert().compile(dialect=self.dialect)
+            names = list(table.columns.keys())
+            if not self.dialect.positional:
+                order = names
+            elif compiled.positiontup == names:
+                order = None
+            else:
+                order = [names.index(k) for k in compiled.positiontup]
+            self._inserts[table.name] = (str(compiled), order)
+        sql, order = self._inserts[table.name]
+        if order and isinstance(order[0], six.string_types):
+            rows = [dict(zip(order, row)) for row in rows]
+        elif order:
+            rows = [tuple(row[i] for i in order) for row in rows]
+        with self.lock:
+            dbapi = self.conn.connection
+            cursor = dbapi.cursor()
+            cursor.executemany(sql, rows)
+            cursor.close()
+            dbapi.commit()
+
+    def execute(self, *args):
+        with self.lock:
+            return self.conn.execute(*args)
+
+    def close(self):
+        for pragma in reversed(self._restore):
+            self.conn.execute(pragma)
+        self.conn.close()
+
+def _copy_partition(genome, table_name, table, part, has_chrom, where, dest,
+                    checkpoints):
+    """
+    copy the rows of a partition (a chromosome or the whole table if it has
+    no chrom column) that match `where` and record it with the checksum of
+    the rows that were read from the source.
+    """
+    from . import _stream_query
+    rows = []
+    checksum = _Checksum()
+    try:
+        q = genome.session.query(*table.columns).filter(
+                        _partition(table, part, has_chrom)).filter(where)
+        for record in _stream_query(q, table):
+            rows.append(tuple(record))
+            checksum.add(rows[-1])
+            if len(rows) == BATCH:
+                dest.insert(table, rows)
+                rows = []
+        if rows:
+            dest.insert(table, rows)
+    finally:
+        # the source sessions are per-thread.
+        genome.session.remove()
+    n, checksum = checksum.value()
+    dest.execute(checkpoints.insert(), dict(tbl=table_name, part=part,
+                              nrows=n, checksum=checksum, verified=False))
+
+def _build_indexes(table, dest):
+    """
+    create the (reflected) indexes of table along with one on (chrom, bin)
+    if it has those columns and then ANALYZE it.
+    """
+    from sqlalchemy import Index
+    indexes = list(table.indexes)
+    cols = table.c
+    if "chrom" in cols and not any(list(i.columns)[0].name == "chrom"
+                                       for i in indexes):
+        if "bin" in cols:
+            indexes.append(Index(table.name + ".chrom_bin_ix", cols.chrom, cols.bin))
+        else:
+            indexes.append(Index(table.name + ".chrom_ix", cols.chrom))
+    # those built by an earlier run are skipped. reflecting a table more
+    # than once can also repeat its indexes.
+    existing = sqlalchemy.inspect(dest.conn).get_indexes(table.name)
+    names = set(i["name"] for i in existing)
+    seen = set(tuple(i["column_names"]) for i in existing)
+    for idx in indexes:
+        key = tuple(c.name for c in idx.columns)
+        if key in seen or idx.name in names: continue
+        seen.add(key)
+        dest.execute(sqlalchemy.schema.CreateIndex(idx))
+    name = dest.dialect.identifier_preparer.quote(table.name)
+    dest.execute({"mysql": "ANALYZE TABLE %s"}.get(dest.dialect.name,
+                                                   "ANALYZE %s") % name)
+
+def _with_stats(connection_string, tables):
+    """
+    return a Genome for `connection_string` after computing the stats (see
+    `cruzdb.Genome.stats`) of `tables` and keeping them in its cruzdb_stats
+    table.
+    """
+    from . import Genome
+    from .stats import stats_table
+    g = Genome(connection_string)
+    stats_table(g.engine, create=True)
+    for name in tables:
+        g.stats(name, refresh=True)
+    return g
+
+def _verify(table, part, has_chrom, dest, checkpoints, expected):
+    """
+    compare the rows of a partition in the destination to the checksum of
+    the rows from the source. if they match, the partition is marked as
+    verified, otherwise it is removed so the next run copies it again.
+    """
+    t = checkpoints
+    where = and_(t.c.tbl == table.name, t.c.part == part)
+    got = _Checksum(dest.execute(select(table.columns).where(
+                                    _partition(table, part, has_chrom)))).value()
+    if got == expected:
+        dest.execute(t.update().where(where).values(verified=True))
+        return True
+    print("ERROR: mirrored table '%s' (%s) has %i rows (checksum %s)"
+          " while the original had %i (checksum %s)" % ((table.name, part)
+              + got + expected), file=sys.stderr)
+    dest.execute(t.delete().where(where))
+    return False
+
+# tables that are copied along with the table they reference when mirror
+# is given regions, and only the rows for features in those regions:
+#   table: (column, referenced table, referenced column)
+DIMENSIONS = {"kgXref": ("kgID", "knownGene", "name"),
+              "knownToRefSeq": ("name", "knownGene", "name"),
+              "refLink": ("mrnaAcc", "refGene", "name")}
+
+def _regions(regions):
+    """normalize chromosomes and (chrom, start, end) regions for mirror"""
+    res = []
+    for r in regions:
+        if isinstance(r, six.string_types):
+            res.append((r, None, None))
+        elif isinstance(r, (tuple, list)):
+            res.append((r[0], int(r[1]), int(r[2])))
+        else:
+            res.append((r.chrom, int(r.start), int(r.end)))
+    return res
+
+def _region_filter(genome, table, regions, tables):
+    """
+    return a where clause that limits `table` to the rows in `regions` (or
+    to the rows referenced by those rows for a table in DIMENSIONS) or None
+    if the whole table is copied.
+    """
+    from . import _bin_clause
+    c = table.c
+    if not "chrom" in c:
+        if not table.name in DIMENSIONS: return None
+        col, ref, ref_col = DIMENSIONS[table.name]
+        if not ref in tables: return None
+        rtable = getattr(genome, ref)._table
+        return c[col].in_(select([rtable.c[ref_col]]).where(
+            _region_filter(genome, rtable, regions, tables)))
+
+    if not ("txStart" in c or "chromStart" in c):
+        return c.chrom.in_(set(chrom for chrom, _, _ in regions))
+    clauses = []
+    for chrom, start, end in regions:
+        if start is None:
+            clauses.append(c.chrom == chrom)
+        else:
+            clauses.append(_bin_clause(table, chrom, start, end,
+                                       genome._plan))
+    return sqlalchemy.or_(*clauses)
+
+def mirror(genome, tables, connection_string, threads=4, regions=None):
+    """
+    copy `tables` from `genome` to the database at `connection_string` and
+    return a Genome for it.
+
+    Large tables with a chrom column are copied in partitions of one
+    chromosome and the partitions (of all of the tables) are copied by
+    `threads` threads. Tables are created without indexes and rows are
+    inserted in bulk; the indexes are built (and the tables analyzed) once
+    all of the rows are loaded. Each partition is recorded in the
+    `cruzdb_mirror` table of the destination and then verified with a
+    checksum of its rows. If mirror is interrupted, running it again copies
+    only the partitions that are not recorded there.
+
+    If `regions` (chromosomes and/or (chrom, start, end) tuples) are given,
+    only the rows in those regions are copied. chromInfo and the tables in
+    DIMENSIONS (e.g. kgXref for knownGene) are added and limited to the
+    rows for those regions. A destination should only be used for one set
+    of regions.
+
+    If `connection_string` is "columnar:///path", the tables are written to
+    that directory in the format of `cruzdb.columnar` and a ColumnarGenome
+    is returned.
+    """
+    from multiprocessing.pool import ThreadPool
+    tables = list(tables)
+    if regions is not None:
+        regions = _regions(regions)
+        # tables that were asked for are copied (or fail) as usual; the ones
+        # added here are skipped if the source doesn't have them.
+        added = [name for name, (_, ref, _) in sorted(DIMENSIONS.items())
+                 if ref in tables and not name in tables]
+        if not "chromInfo" in tables:
+            added.append("chromInfo")
+        tables.extend(t for t in added if genome.engine.dialect.has_table(
+                                                    genome.engine, t))
+    if connection_string.startswith("columnar://"):
+        from .columnar import mirror_columnar
+        return mirror_columnar(genome, tables, connection_string, regions)
+    new = _new_sqlite(connection_string)
     destination, dengine = make_session(connection_string)
     dmeta = MetaData(bind=dengine)
+    checkpoints = _checkpoint_table(dengine)
+    done = dict(((r.tbl, r.part), r) for r in
+                dengine.execute(checkpoints.select()))
+    dest = _Destination(connection_string, new)
 
-    orig_counts = []
+    jobs, parts_of = [], []
     for table_name in tables:
         # cause it ot be mapped
         table = getattr(genome, table_name)._table
-        print('Mirroring', table_name, file=sys.stderr)
 
         table = set_table(genome, table, table_name,
                 connection_string, dmeta)
-        try:
-            table.create(dengine)
-        except sqlalchemy.exc.OperationalError:
-            pass
-
-        destination.commit()
-        ins = table.insert()
-
-        columns = list(table.columns.keys())
-        records = []
-        table_obj = getattr(genome, table_name)._table
-        t = getattr(genome, table_name)
-        for ii, record in enumerate(page_query(table_obj.select(), t.session)):
-            data = dict(
-                (str(column), getattr(record, column)) for column in columns
-            )
-            records.append(data)
-            if ii % 20000 == 0 and ii > 0:
-                destination.execute(ins, records)
-                print("processing record %i" % ii, file=sys.stderr)
-                destination.commit()
-                records = []
-        destination.execute(ins, records)
-        destination.commit()
-        orig_counts.append(getattr(genome, table_name).count())
+        if not dengine.dialect.has_table(dest.conn, table_name):
+            # the indexes are built after the rows are loaded.
+            dest.execute(sqlalchemy.schema.CreateTable(table))
 
-    destination, dengine = make_session(connection_string)
-    from . import Genome
-    newg = Genome(connection_string)
-    new_counts = [getattr(newg, table_name).count() for table_name in tables]
-    for tbl, oc, nc in zip(tables, orig_counts, new_counts):
-        if oc != nc: print("ERROR: mirrored table '%s' has %i \
-            rows while the original had %i" % (tbl, nc, oc), file=sys.stderr)
-    return newg
+        where = None if regions is None else \
+                _region_filter(genome, table, regions, tables)
+        if where is None:
+            where = sqlalchemy.true()
+        has_chrom = "chrom" in table.c and genome.session.query(
+                sqlalchemy.func.count(table.c.chrom)).scalar() > PARTITION_ROWS
+        if has_chrom:
+            parts = [r[0] for r in
+                     genome.session.query(table.c.chrom).filter(where).distinct()]
+        else:
+            parts = [""]
+        todo = [p for p in parts if not (table_name, p) in done]
+        print('Mirroring %s (%i of %i partitions)' % (table_name, len(todo),
+                                                     len(parts)), file=sys.stderr)
+        if todo:
+            # rows left by an interrupted run.
+            recorded = [p for p in parts if (table_name, p) in done]
+            dest.execute(table.delete().where(
+                ~table.c.chrom.in_(recorded) if recorded else sqlalchemy.true()))
+        jobs.extend((table_name, table, p, has_chrom, where) for p in todo)
+        parts_of.append((table, parts, has_chrom))
+
+    pool = ThreadPool(threads)
+    try:
+        results = [pool.apply_async(_copy_partition, (genome, table_name,
+                            table, part, has_chrom, where, dest, checkpoints))
+                   for table_name, table, part, has_chrom, where in jobs]
+        for r in results:
+            r.get()
+        pool.close()
+
+        bad = 0
+        done = dict(((r.tbl, r.part), r) for r in
+                    dest.execute(checkpoints.select()))
+        for table, parts, has_chrom in parts_of:
+            print('Indexing %s' % table.name, file=sys.stderr)
+            _build_indexes(table, dest)
+            for part in parts:
+                r = done[(table.name, part)]
+                if r.verified: continue
+                bad += not _verify(table, part, has_chrom, dest, checkpoints,
+                                   (r.nrows, r.checksum))
+    finally:
+        pool.terminate()
+        pool.join()
+        dest.close()
+    if bad:
+        print("ERROR: %i partitions did not match; run mirror again to "
+              "copy them" % bad, file=sys.stderr)
+
+    return _with_stats(connection_string, [t.name for t, _, _ in parts_of])
+
+# bytes of the decompressed dump that are parsed at once by a worker.
+DUMP_BLOCK = 4 << 20
+
+def parse_schema(sql, connection_string):
+    """
+    return a Table (in its own MetaData) from the CREATE TABLE statement in
+    `sql`, the contents of a UCSC .sql file (mysqldump output), with the
+    types converted as for `mirror`. The keys become indexes that are built
+    after the rows are loaded.
+    """
+    from sqlalchemy.dialects.mysql import base, reflection
+    from sqlalchemy import Index
+    import re
+    m = re.search(r"CREATE TABLE .*?\)[^)]*?;\s*$", sql, re.S | re.M)
+    if m is None:
+        raise ValueError("no CREATE TABLE statement found")
+    dialect = base.MySQLDialect()
+    state = reflection.MySQLTableDefinitionParser(dialect,
+                dialect.identifier_preparer).parse(m.group(0), "latin1")
+    table = Table(state.table_name, MetaData(),
+                  *[Column(c["name"], c["type"], nullable=c["nullable"])
+                    for c in state.columns])
+    portable_columns(table, connection_string)
+    for i, key in enumerate(state.keys):
+        if not key["type"] in (None, "PRIMARY", "UNIQUE"): continue
+        Index(state.table_name + "." + (key["name"] or "PRIMARY") + "_ix" +
+              str(i), *[table.c[c[0]] for c in key["columns"]],
+              unique=key["type"] is not None)
+    return table, state.table_options.get("mysql_default charset", "latin1")
+
+_MYSQL_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t",
+                  "Z": "\x1a"}
+
+def _unescape(m):
+    c = m.group(1)
+    return _MYSQL_ESCAPES.get(c, c)
+
+def _escaped(text, i):
+    """is the character at `i` in `text` escaped (an odd number of \\ before)?"""
+    j = i
+    while j > 0 and text[j - 1:j] in ("\\", b"\\"):
+        j -= 1
+    return (i - j) % 2 == 1
+
+def _split_unescaped(text, sep):
+    """
+    split `text` on `sep` except where it is escaped. a dump writes a tab
+    or newline in a field as a backslash followed by the character.
+    """
+    parts = text.split(sep)
+    if not "\\" in text:
+        return parts
+    fields = [parts[0]]
+    for part in parts[1:]:
+        if _escaped(fields[-1], len(fields[-1])):
+            fields[-1] += sep + part
+        else:
+            fields.append(part)
+    return fields
+
+def _parse_dump_block(args):
+    """
+    parse the tab-delimited rows in a block of a dump (SELECT ... INTO
+    OUTFILE format) to tuples. `kinds` has int or float for each column
+    that is converted (None for text).
+    """
+    import re
+    block, kinds, encoding = args
+    escaped = re.compile(r"\\(.)", re.S)
+    rows = []
+    for line in _split_unescaped(block.decode(encoding), "\n"):
+        if not line: continue
+        row = _split_unescaped(line, "\t")
+        for i, v in enumerate(row):
+            if v == "\\N":
+                row[i] = None
+                continue
+            if "\\" in v:
+                v = row[i] = escaped.sub(_unescape, v)
+            if kinds[i] is not None:
+                row[i] = kinds[i](v)
+        rows.append(tuple(row))
+    return rows
+
+def _dump_blocks(data_path, size=DUMP_BLOCK):
+    """
+    yield blocks of whole lines from a (gzipped) dump (which end at a
+    newline that isn't escaped). The decompression is done by pigz (or
+    gzip) in another process when available.
+    """
+    try:
+        from shutil import which
+    except ImportError: # python 2
+        from distutils.spawn import find_executable as which
+    import subprocess
+    proc = None
+    if data_path.endswith(".gz"):
+        exe = which("pigz") or which("gzip")
+        if exe:
+            proc = subprocess.Popen([exe, "-dc", data_path],
+                                    stdout=subprocess.PIPE, bufsize=-1)
+            fh = proc.stdout
+        else:
+            import gzip
+            fh = gzip.open(data_path, "rb")
+    else:
+        fh = open(data_path, "rb")
+    try:
+        rest = b""
+        while True:
+            chunk = fh.read(size)
+            if not chunk: break
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n")
+            while end >= 0 and _escaped(chunk, end):
+                end = chunk.rfind(b"\n", 0, end)
+            end += 1
+            if end == 0:
+                rest = chunk
+                continue
+            rest = chunk[end:]
+            yield chunk[:end]
+        if rest:
+            yield rest
+    finally:
+        fh.close()
+        if proc is not None and proc.wait() != 0:
+            raise IOError("could not decompress %s" % data_path)
+
+def load_dump(schema_path, data_path, connection_string, processes=None):
+    """
+    load a table from a UCSC database dump (a .sql schema and a .txt.gz of
+    the rows, as in http://hgdownload.cse.ucsc.edu/goldenPath/hg19/database/)
+    into the database at `connection_string` and return a Genome for it. No
+    connection to UCSC is needed. As in the dump, an existing table of the
+    same name is replaced.
+
+    The file is decompressed in another process and blocks of it are
+    parsed by `processes` worker processes while the rows are inserted in
+    bulk; the indexes are built after the rows are loaded.
+    """
+    from multiprocessing import Pool, cpu_count
+    from collections import deque
+    with open(schema_path) as fh:
+        table, encoding = parse_schema(fh.read(), connection_string)
+    if encoding.startswith("utf8"):
+        encoding = "utf-8"
+    kinds = []
+    for col in table.columns:
+        if isinstance(col.type, sqlalchemy.Integer):
+            kinds.append(int)
+        elif isinstance(col.type, (sqlalchemy.Float, sqlalchemy.Numeric)):
+            kinds.append(float)
+        else:
+            kinds.append(None)
+
+    processes = processes or cpu_count()
+    dest = _Destination(connection_string, _new_sqlite(connection_string))
+    pool = Pool(processes)
+    try:
+        if dest.dialect.has_table(dest.conn, table.name):
+            dest.execute(sqlalchemy.schema.DropTable(table))
+        dest.execute(sqlalchemy.schema.CreateTable(table))
+
+        def insert(rows):
+            for i in range(0, len(rows), BATCH):
+                dest.insert(table, rows[i:i + BATCH])
+            return len(rows)
+
+        n, pending = 0, deque()
+        for block in _dump_blocks(data_path):
+            pending.append(pool.apply_async(_parse_dump_block,
+                                            ((block, kinds, encoding),)))
+            # limit the blocks held in memory.
+            if len(pending) >= 2 * processes:
+                n += insert(pending.popleft().get())
+        while pending:
+            n += insert(pending.popleft().get())
+        pool.close()
+        print("Loaded %i rows into %s; indexing" % (n, table.name),
+              file=sys.stderr)
+        _build_indexes(table, dest)
+    finally:
+        pool.terminate()
+        pool.join()
+        dest.close()
+
+    return _with_stats(connection_string, [table.name])
 
 if __name__ == "__main__":
     if True:
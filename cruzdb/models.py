@@ -22,6 +22,7 @@ from .sequence import sequence as _sequence
 from .__init__ import Genome
 
 import re
+import keyword
 
 if six.PY3:
     long = int
@@ -130,17 +131,14 @@ class Interval(object):
             return self.start - other_end
         return 0
 
-class ABase(object):
+class _Row(object):
     """
-    Base object that wraps returned database rows
+    The helpers shared by the mapped rows (see ABase) and Records. It has
+    no __dict__ so that Records only hold their slots.
     """
+    __slots__ = ()
 
     _prefix_chain = ("tx", "chrom")
-    @declared_attr
-    def __tablename__(cls):
-        return cls.__name__
-    __table_args__ = {'autoload': True}
-    __mapper_args__= {'always_refresh': False, 'exclude_properties': ['dist', '_dist']}
 
     anno_cols = ("name", "distance", "feature")
 
@@ -719,6 +717,16 @@ def get_start_end(other_or_start, end):
         other_start, other_end = other_or_start, end
     return other_start, other_end
 
+class ABase(_Row):
+    """
+    Base object that wraps returned database rows
+    """
+    @declared_attr
+    def __tablename__(cls):
+        return cls.__name__
+    __table_args__ = {'autoload': True}
+    __mapper_args__= {'always_refresh': False, 'exclude_properties': ['dist', '_dist']}
+
 class Feature(ABase):
     name = Column(String, unique=False, primary_key=True)
 
@@ -861,3 +869,71 @@ class all_mrna(ABase):
     __tablename__ = "all_mrna"
 
     qName = Column(String, unique=False, primary_key=True)
+
+_record_classes = {}
+# class attributes of the models that are not copied to Records.
+_mapping_attrs = ("__dict__", "__weakref__", "__module__", "__qualname__",
+                  "__doc__", "__tablename__", "__table_args__",
+                  "__mapper_args__")
+_identifier = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+class Record(_Row):
+    """
+    A lightweight, read-only row. It is not mapped or attached to a session
+    (so there is no identity map or change tracking) but has the same
+    helpers (start, end, exons, distance, bed, ...) as the mapped rows.
+
+    Use `Record.for_table` to get the class for a particular table.
+    """
+    __slots__ = ()
+    _columns = ()
+    _db = None
+
+    def __init__(self, values):
+        for k, v in zip(self._columns, values):
+            setattr(self, k, v)
+
+    @property
+    def db(self):
+        return self._db
+
+    def __iter__(self):
+        for k in self._columns:
+            yield str(getattr(self, k, ""))
+
+    @classmethod
+    def for_table(cls, table_name, columns, db=None):
+        """
+        return a (cached) Record class with a slot for each of `columns`. If
+        there is a model for `table_name` in this module (e.g.
+        cpgIslandExt), its methods are used.
+        """
+        columns = tuple(str(c) for c in columns)
+        key = (table_name, columns, db)
+        try:
+            return _record_classes[key]
+        except KeyError:
+            pass
+        # the methods of the model are copied rather than inherited as the
+        # models have a __dict__.
+        attrs = {}
+        base = globals().get(table_name)
+        if isinstance(base, type) and issubclass(base, ABase):
+            for klass in reversed(base.__mro__):
+                if not issubclass(klass, ABase) or klass is ABase: continue
+                attrs.update((k, v) for k, v in vars(klass).items()
+                             if not k in _mapping_attrs and not k in columns
+                             and not isinstance(v, Column))
+        attrs.update(__slots__=columns, _columns=columns, _db=db,
+                     __tablename__=str(table_name))
+        if columns and all(_identifier.match(c) and not keyword.iskeyword(c)
+                           for c in columns):
+            # assigning all of the slots by unpacking the row is several
+            # times faster than a setattr for each column.
+            ns = {}
+            exec("def __init__(self, values):\n    (%s,) = values\n" %
+                 ", ".join("self." + c for c in columns), ns)
+            attrs["__init__"] = ns["__init__"]
+        klass = type(str(table_name), (cls,), attrs)
+        _record_classes[key] = klass
+        return klass
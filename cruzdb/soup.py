@@ -1,5 +1,10 @@
 from . import sqlsoup
-from sqlalchemy import Table, util
+from sqlalchemy import Table, util, LargeBinary
+from sqlalchemy.orm import deferred
+from sqlalchemy.dialects.mysql import TINYBLOB, MEDIUMBLOB, LONGBLOB
+
+def _is_blob(col):
+    return isinstance(col.type, (LargeBinary, TINYBLOB, MEDIUMBLOB, LONGBLOB))
 
 class Genome(sqlsoup.SQLSoup):
 
@@ -23,6 +28,10 @@ class Genome(sqlsoup.SQLSoup):
 
         mapper_args = dict(mapper_args)
         mapper_args['primary_key'] = pids
+        if getattr(self, "defer_blobs", False):
+            # loaded from the database only when they are accessed.
+            mapper_args['properties'] = dict((c.name, deferred(c,
+                    group="blobs")) for c in tbl.columns if _is_blob(c))
         return sqlsoup.SQLSoup.map_to(self, attrname, tablename, selectable,
                                        schema, base=base, mapper_args=mapper_args)
 
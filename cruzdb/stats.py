@@ -0,0 +1,193 @@
+"""
+Statistics about the rows of a table (counts per chromosome, feature
+lengths, bins and indexes) that are used to plan spatial queries. See
+`cruzdb.Genome.stats`.
+
+They are read from the database once with a scan of the table. A local
+copy made with `cruzdb.mirror` (or `Genome.load_ucsc_dump`) keeps them in
+its `cruzdb_stats` table so later sessions don't scan again.
+"""
+from __future__ import print_function
+import json
+from bisect import bisect_left, bisect_right
+
+# feature lengths are counted in buckets below each of these (and then the
+# rest).
+LENGTH_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+STATS_TABLE = "cruzdb_stats"
+
+
+class TableStats(object):
+    """
+    Summary of the rows of a table.
+
+    Attributes
+    ----------
+
+    table : str
+        name of the table
+
+    count : int
+        number of rows
+
+    rows : dict
+        number of rows on each chromosome
+
+    max_length : dict
+        length of the longest feature on each chromosome
+
+    span : dict
+        largest end of a feature on each chromosome
+
+    lengths : list
+        number of features shorter than each of `LENGTH_BUCKETS` (but not
+        the one before) followed by the number of longer features
+
+    bins : dict
+        number of rows in each UCSC bin (for tables with a bin column)
+
+    indexes : list
+        tuples of the columns of the primary key and each index
+    """
+
+    def __init__(self, table, count=0, rows=None, max_length=None, span=None,
+                 lengths=None, bins=None, indexes=None):
+        self.table, self.count = table, count
+        self.rows = rows or {}
+        self.max_length = max_length or {}
+        self.span = span or {}
+        self.lengths = lengths or [0] * (len(LENGTH_BUCKETS) + 1)
+        self.bins = bins or {}
+        self.indexes = [tuple(i) for i in indexes or ()]
+        self._cumulative = None
+
+    def __repr__(self):
+        return "%s(%r, count=%i, chroms=%i, indexes=%i)" % (
+                self.__class__.__name__, self.table, self.count,
+                len(self.rows), len(self.indexes))
+
+    def density(self, chrom):
+        """features per base on `chrom`"""
+        return self.rows.get(chrom, 0) / float(max(1, self.span.get(chrom, 0)))
+
+    def length_quantile(self, q):
+        """
+        return the length that at least the fraction `q` of the features are
+        shorter than (from the buckets, so one of `LENGTH_BUCKETS`) or the
+        longest feature if that's beyond the last bucket.
+        """
+        total, seen = sum(self.lengths), 0
+        for limit, n in zip(LENGTH_BUCKETS, self.lengths):
+            seen += n
+            if seen >= q * total:
+                return limit
+        return max(self.max_length.values() or [0])
+
+    def bin_rows(self, chrom, ranges):
+        """
+        estimate the number of rows on `chrom` in the (first, last) bin
+        `ranges`. The bins are counted over all chromosomes so this assumes
+        each chromosome has the same share of every bin.
+        """
+        if self._cumulative is None:
+            self._sorted_bins = sorted(self.bins)
+            self._cumulative = [0]
+            for b in self._sorted_bins:
+                self._cumulative.append(self._cumulative[-1] + self.bins[b])
+        bins, cum = self._sorted_bins, self._cumulative
+        n = sum(cum[bisect_right(bins, last)] - cum[bisect_left(bins, first)]
+                for first, last in ranges)
+        return n * self.rows.get(chrom, 0) / float(max(1, self.count))
+
+    def has_index(self, *columns):
+        """is there an index that starts with `columns`?"""
+        return any(i[:len(columns)] == columns for i in self.indexes)
+
+    def to_json(self):
+        return json.dumps(dict(table=self.table, count=self.count,
+            rows=self.rows, max_length=self.max_length, span=self.span,
+            lengths=self.lengths, indexes=self.indexes,
+            bins=sorted(self.bins.items())), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, text):
+        d = json.loads(text)
+        d["bins"] = dict(d["bins"])
+        return cls(**dict((str(k), v) for k, v in d.items()))
+
+
+def compute(genome, tbl):
+    """
+    read the TableStats of the sqlalchemy Table `tbl` from `genome`.
+    """
+    from sqlalchemy import select, func, case
+    from . import _start_end_columns
+    conn = genome.session.connection(bind=genome.engine)
+    c = tbl.c
+    indexes = []
+    if len(tbl.primary_key.columns):
+        indexes.append(tuple(col.name for col in tbl.primary_key.columns))
+    indexes.extend(tuple(col.name for col in i.columns) for i in
+                   sorted(tbl.indexes, key=lambda i: i.name))
+    stats = TableStats(tbl.name, indexes=indexes)
+
+    if not hasattr(c, "chrom"):
+        stats.count = conn.execute(select([func.count()]).select_from(tbl)
+                                   ).scalar()
+        return stats
+    spatial = hasattr(c, "txStart") or hasattr(c, "chromStart")
+    group = [c.chrom] + ([c.bin] if hasattr(c, "bin") else [])
+    cols = group + [func.count()]
+    if spatial:
+        cstart, cend = _start_end_columns(tbl)
+        cols.extend([func.max(cend - cstart), func.max(cend)])
+    for row in conn.execute(select(cols).group_by(*group)):
+        chrom, n = row[0], row[len(group)]
+        stats.count += n
+        stats.rows[chrom] = stats.rows.get(chrom, 0) + n
+        if len(group) > 1:
+            stats.bins[row[1]] = stats.bins.get(row[1], 0) + n
+        if spatial:
+            stats.max_length[chrom] = max(stats.max_length.get(chrom, 0),
+                                          row[-2] or 0)
+            stats.span[chrom] = max(stats.span.get(chrom, 0), row[-1] or 0)
+    if spatial:
+        length = cend - cstart
+        bucket = case([(length < limit, i) for i, limit in
+                       enumerate(LENGTH_BUCKETS)], else_=len(LENGTH_BUCKETS))
+        for i, n in conn.execute(select([bucket, func.count()]).group_by(
+                                                                    bucket)):
+            stats.lengths[i] = n
+    return stats
+
+
+def stats_table(engine, create=False):
+    """
+    the table where a database keeps the stats of its tables or None if it
+    doesn't have one (and `create` is False).
+    """
+    from sqlalchemy import Table, MetaData, Column, String, Text
+    if not create and not engine.dialect.has_table(engine, STATS_TABLE):
+        return None
+    t = Table(STATS_TABLE, MetaData(), Column("tbl", String(64)),
+              Column("stats", Text))
+    t.create(engine, checkfirst=True)
+    return t
+
+
+def load(engine):
+    """return a dict of the TableStats kept in the database"""
+    t = stats_table(engine)
+    if t is None:
+        return {}
+    return dict((r.tbl, TableStats.from_json(r.stats)) for r in
+                engine.execute(t.select()))
+
+
+def save(engine, stats):
+    """keep `stats` in the database, replacing any for the same table"""
+    t = stats_table(engine, create=True)
+    with engine.begin() as conn:
+        conn.execute(t.delete().where(t.c.tbl == stats.table))
+        conn.execute(t.insert(), dict(tbl=stats.table, stats=stats.to_json()))
@@ -0,0 +1,182 @@
+"""
+Sort-merge (sweep-line) nearest neighbor search.
+
+When the query features are sorted by chromosome and start, the k nearest
+features for every query can be found with a single forward pass over the
+features of each chromosome (also sorted by start). This is O(n + m) rather
+than a search (or a database query) per query feature.
+
+    >>> from cruzdb.intersecter import Intersecter, Feature
+    >>> feats = Intersecter([Feature(0, 10, chrom="chr1"),
+    ...                      Feature(20, 30, chrom="chr1"),
+    ...                      Feature(45, 60, chrom="chr1")])
+    >>> queries = [Feature(12, 14, chrom="chr1"), Feature(31, 32, chrom="chr1")]
+    >>> [(q, n) for q, n in closest(queries, feats)]
+    [(Feature(12, 14, chrom=chr1), [Feature(0, 10, chrom=chr1)]), (Feature(31, 32, chrom=chr1), [Feature(20, 30, chrom=chr1)])]
+
+"""
+from __future__ import print_function
+from bisect import bisect_left, bisect_right
+from collections import deque
+from operator import itemgetter
+
+from .intersecter import Intersecter, Feature
+
+
+class Sweep(object):
+    """
+    Find the k nearest neighbors (including ties) of a stream of query
+    features sorted by chromosome and then start. Features are read from
+    `features` one chromosome at a time and only the ones near the current
+    position are kept in memory.
+
+    Queries that arrive out of order (a start lower than the previous start
+    or a chromosome that was already passed) are still answered, but with a
+    regular knearest search rather than from the sweep.
+
+    Parameters
+    ----------
+
+    features : Intersecter or table
+        an Intersecter, or a table (or query) from a Genome. Tables are read
+        a chromosome at a time ordered by start.
+
+    k : int
+        number of neighbors to report for each query
+
+    genome : Genome
+        the Genome that `features` is from. Not needed for an Intersecter.
+    """
+
+    def __init__(self, features, k=1, genome=None):
+        assert k > 0
+        self.k = k
+        self.features, self.genome = features, genome
+        if isinstance(features, Intersecter):
+            self._fallback = lambda q, k: features.knearest(q.start, q.end,
+                                                    chrom=q.chrom, k=k)
+        else:
+            from . import _start_end_columns
+            self.features, tbl = genome._table_for(features)
+            self._tbl = tbl
+            self._start_col, self._end_col = _start_end_columns(tbl)
+            self._fallback = lambda q, k: genome.knearest(self.features,
+                                            q.chrom, q.start, q.end, k=k)
+        self._chrom = None
+        self._seen = set()
+
+    def _chrom_features(self, chrom, start):
+        """
+        return the features left of `start` that are nearest to it (k plus
+        ties) and an iterator over the rest of the features on `chrom` in
+        order of start. The iterator may include some features that end
+        before `start`.
+        """
+        if isinstance(self.features, Intersecter):
+            left = self.features.left(Feature(start, start, chrom=chrom), self.k)
+            return left, iter(self.features.chrom_intervals(chrom, start))
+        from . import _nearest_scan
+        q = self.features.filter(self._tbl.c.chrom == chrom)
+        left = _nearest_scan(q.filter(self._end_col < start), self._end_col,
+                             self.k, descending=True)
+        q = q.filter(self._end_col >= start).order_by(self._start_col)
+        return left, iter(q.yield_per(10000))
+
+    def _reset(self, chrom, start):
+        self._chrom = chrom
+        self._seen.add(chrom)
+        # start the sweep at the first query rather than at the start of
+        # the chromosome.
+        left, self._feats = self._chrom_features(chrom, start)
+        self._first_start = start
+        self._exhausted = False
+        self._last_start = None
+        # read, but starting after the end of the last query.
+        self._pending = deque()
+        # read and not known to be entirely left of the current query.
+        self._active = []
+        # the features entirely left of the current query with the largest
+        # ends (only k of them, plus ties, can ever be needed again).
+        self._left_ends, self._left = [], []
+        for f in left:
+            self._add_left(f)
+
+    def _add_left(self, f):
+        i = bisect_right(self._left_ends, f.end)
+        self._left_ends.insert(i, f.end)
+        self._left.insert(i, f)
+        if len(self._left) > self.k:
+            cut = bisect_left(self._left_ends, self._left_ends[-self.k])
+            del self._left_ends[:cut], self._left[:cut]
+
+    def knearest(self, q):
+        """
+        return the k nearest features to `q` which must have chrom, start
+        and end attributes.
+        """
+        k = self.k
+        if q.chrom != self._chrom:
+            if q.chrom in self._seen:
+                return list(self._fallback(q, k))
+            self._reset(q.chrom, q.start)
+        elif q.start < self._last_start:
+            return list(self._fallback(q, k))
+        self._last_start = q.start
+
+        pending, active = self._pending, self._active
+        while pending and pending[0].start <= q.end:
+            active.append(pending.popleft())
+
+        # read ahead until we have the k (plus ties) features that start
+        # after this query.
+        while not self._exhausted and not (len(pending) > k and
+                    pending[-1].start != pending[k - 1].start):
+            try:
+                f = next(self._feats)
+            except StopIteration:
+                self._exhausted = True
+                break
+            # these are already accounted for by the left search in _reset
+            if f.end < self._first_start: continue
+            (active if f.start <= q.end else pending).append(f)
+
+        cands = []
+        still_active = []
+        for f in active:
+            if f.end < q.start:
+                self._add_left(f)
+            else:
+                still_active.append(f)
+                cands.append((max(0, f.start - q.end), f))
+        self._active = still_active
+
+        cands.extend((q.start - f.end, f) for f in self._left)
+        for i, f in enumerate(pending):
+            if i >= k and f.start != pending[k - 1].start: break
+            cands.append((f.start - q.end, f))
+
+        return _k_with_ties(cands, k)
+
+
+
+def _k_with_ties(cands, k):
+    """
+    given a list of (distance, feature) return the features with the k
+    smallest distances along with any that tie the kth.
+    """
+    cands.sort(key=itemgetter(0))
+    kk = k
+    while kk < len(cands) and cands[kk][0] == cands[k - 1][0]:
+        kk += 1
+    return [f for d, f in cands[:kk]]
+
+
+def closest(queries, features, k=1, genome=None):
+    """
+    yield (query, [neighbors]) for each feature in `queries` with the k
+    nearest neighbors (plus ties) from `features`. `queries` should be
+    sorted by chromosome and then start; see `Sweep`.
+    """
+    sweep = Sweep(features, k=k, genome=genome)
+    for q in queries:
+        yield q, sweep.knearest(q)
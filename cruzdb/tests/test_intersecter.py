@@ -0,0 +1,109 @@
+import unittest
+import random
+from cruzdb.intersecter import Intersecter, ArrayIntersecter, Feature, \
+        distance
+
+
+def random_features(n, seed=1, chroms=("chr1", "chr2"), max_len=5000):
+    random.seed(seed)
+    feats = []
+    for i in range(n):
+        s = random.randint(0, 1000000)
+        feats.append(Feature(s, s + random.randint(1, max_len),
+                             chrom=random.choice(chroms)))
+    return feats
+
+
+def brute(feats, f, n, keep=lambda o: True):
+    ds = sorted(distance(f, o) for o in feats if o.chrom == f.chrom and keep(o))
+    if len(ds) > n: ds = [d for d in ds if d <= ds[n - 1]]
+    return ds
+
+
+class TestNeighbors(unittest.TestCase):
+    def setUp(self):
+        # sparse, so left has to widen its search.
+        self.feats = random_features(300)
+        self.queries = random_features(300, seed=5)
+
+    def _check(self, inter):
+        for n in (1, 3):
+            for q in self.queries:
+                d = lambda res: sorted(distance(q, o) for o in res)
+                self.assertEqual(d(inter.left(q, n)), brute(self.feats, q, n,
+                                 lambda o: o.end < q.start))
+                self.assertEqual(d(inter.right(q, n)), brute(self.feats, q, n,
+                                 lambda o: o.start > q.end))
+                self.assertEqual(d(inter.knearest(q, k=n)),
+                                 brute(self.feats, q, n))
+
+    def test_intersecter(self):
+        self._check(Intersecter(self.feats))
+
+    def test_nclist(self):
+        self._check(Intersecter(self.feats, index="nclist"))
+
+    def test_array(self):
+        self._check(ArrayIntersecter(self.feats))
+
+    def test_array_ids(self):
+        ai = ArrayIntersecter.from_arrays([f.chrom for f in self.feats],
+                                          [f.start for f in self.feats],
+                                          [f.end for f in self.feats])
+        for n in (1, 3):
+            for q in self.queries:
+                d = lambda ids: sorted(distance(q, self.feats[i]) for i in ids)
+                self.assertEqual(d(ai.left(q, n)), brute(self.feats, q, n,
+                                 lambda o: o.end < q.start))
+                self.assertEqual(d(ai.right(q, n)), brute(self.feats, q, n,
+                                 lambda o: o.start > q.end))
+                self.assertEqual(d(ai.knearest(q, k=n)),
+                                 brute(self.feats, q, n))
+
+    def test_upstream(self):
+        inter = Intersecter(self.feats)
+        q = self.queries[0]
+        q.strand = -1
+        self.assertEqual(inter.upstream(q, 2), inter.right(q, 2))
+        self.assertEqual(inter.downstream(q, 2), inter.left(q, 2))
+
+
+class TestNCList(unittest.TestCase):
+    def test_find_with_outliers(self):
+        feats = random_features(5000)
+        feats.extend(random_features(3, seed=3, max_len=500000))
+        base = Intersecter(feats)
+        ncl = Intersecter(feats, index="nclist")
+        for q in random_features(2000, seed=2, chroms=("chr1", "chr2", "chr3")):
+            self.assertEqual(base.find(q.start, q.end, q.chrom),
+                             ncl.find(q.start, q.end, q.chrom))
+
+
+class TestArrayIntersecter(unittest.TestCase):
+    def setUp(self):
+        self.feats = random_features(5000)
+        self.queries = random_features(2000, seed=2,
+                                       chroms=("chr1", "chr2", "chr3"))
+
+    def test_find(self):
+        base = Intersecter(self.feats)
+        ai = ArrayIntersecter(self.feats)
+        for q in self.queries:
+            self.assertEqual(set(map(id, base.find(q.start, q.end, q.chrom))),
+                             set(map(id, ai.find(q.start, q.end, q.chrom))))
+
+    def test_find_many(self):
+        ai = ArrayIntersecter.from_arrays([f.chrom for f in self.feats],
+                                          [f.start for f in self.feats],
+                                          [f.end for f in self.feats])
+        qs = self.queries
+        offsets, hits = ai.find_many([q.chrom for q in qs],
+                                     [q.start for q in qs],
+                                     [q.end for q in qs], chunk=300)
+        self.assertEqual(len(offsets), len(qs) + 1)
+        for i, q in enumerate(qs):
+            self.assertEqual(sorted(hits[offsets[i]:offsets[i + 1]].tolist()),
+                             sorted(ai.find(q.start, q.end, q.chrom).tolist()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,616 @@
+"""
+tests that run against a small, randomly generated sqlite database so they
+don't need a connection to UCSC.
+"""
+import unittest
+import random
+import tempfile
+import sqlite3
+import os
+from cruzdb import Genome
+
+
+def ucsc_bin(start, end):
+    start >>= 17
+    end = (end - 1) >> 17
+    for offset in (585, 73, 9, 1):
+        if start == end: return offset + start
+        start >>= 3
+        end >>= 3
+    return 0
+
+def make_db(path, n=2000, seed=42):
+    random.seed(seed)
+    c = sqlite3.connect(path)
+    c.execute("""CREATE TABLE refGene (bin integer, name varchar(255),
+               chrom varchar(255), strand char(1), txStart integer,
+               txEnd integer, cdsStart integer, cdsEnd integer,
+               exonCount integer, exonStarts blob, exonEnds blob,
+               name2 varchar(255))""")
+    rows = []
+    for i in range(n):
+        chrom = random.choice(("chr1", "chr2"))
+        s = random.randint(0, 4000000)
+        e = s + random.randint(100, 40000)
+        rows.append((ucsc_bin(s, e), "NM_%i" % i, chrom, random.choice("+-"),
+                     s, e, s + 10, e - 10, 1, ("%i," % s).encode(),
+                     ("%i," % e).encode(), "G%i" % i))
+    c.executemany("INSERT INTO refGene VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+    c.execute("CREATE INDEX refGene_chrom_bin ON refGene (chrom, bin)")
+    c.commit()
+    c.close()
+
+def brute_nearest(feats, chrom, start, end, k):
+    def dist(f):
+        if start > f.end: return start - f.end
+        if f.start > end: return f.start - end
+        return 0
+    ds = sorted((dist(f), f.name) for f in feats if f.chrom == chrom)
+    if len(ds) <= k: return set(n for d, n in ds)
+    return set(n for d, n in ds if d <= ds[k - 1][0])
+
+
+class TestLocal(unittest.TestCase):
+    def setUp(self):
+        fh, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fh)
+        os.unlink(self.path)
+        make_db(self.path)
+        self.g = Genome("sqlite:///" + self.path)
+        random.seed(12)
+        self.regions = []
+        for i in range(300):
+            s = random.randint(0, 4000000)
+            self.regions.append((random.choice(("chr1", "chr2", "chr3")),
+                                 s, s + random.randint(1, 30000)))
+
+    def test_bin_query_many(self):
+        many = {}
+        for i, f in self.g.bin_query_many("refGene", self.regions, chunk=64):
+            many.setdefault(i, set()).add(f.name)
+        for i, r in enumerate(self.regions):
+            one = set(f.name for f in self.g.bin_query("refGene", *r))
+            self.assertEqual(one, many.get(i, set()))
+
+    def test_bin_zero(self):
+        # a feature across a 64Mb boundary is in bin 0.
+        c = sqlite3.connect(self.path)
+        c.executemany("""INSERT INTO refGene (bin, name, chrom, txStart, txEnd)
+                         VALUES (?, ?, 'chr1', ?, ?)""", [
+            (ucsc_bin(s, e), name, s, e) for name, s, e in
+                [("NM_wide", 67100000, 67200000),
+                 ("NM_near", 67110000, 67110500)]])
+        c.commit()
+        c.close()
+        region = ("chr1", 67108000, 67108900)
+        self.assertEqual(ucsc_bin(67100000, 67200000), 0)
+        self.assertEqual([f.name for f in self.g.bin_query("refGene", *region)],
+                         ["NM_wide"])
+        self.assertEqual([f.name for i, f in
+                          self.g.bin_query_many("refGene", [region])],
+                         ["NM_wide"])
+        self.assertEqual([[f.name for f in fs] for i, fs in
+                          self.g.knearest_many("refGene", [region])],
+                         [["NM_wide"]])
+
+    def test_knearest(self):
+        feats = self.g.refGene.all()
+        for i, (chrom, start, end) in enumerate(self.regions):
+            k = (1, 2, 5)[i % 3]
+            res = self.g.knearest("refGene", chrom, start, end, k=k)
+            self.assertEqual(set(f.name for f in res),
+                             brute_nearest(feats, chrom, start, end, k))
+
+    def test_knearest_many(self):
+        feats = self.g.refGene.all()
+        for k in (1, 3):
+            res = list(self.g.knearest_many("refGene", self.regions, k=k,
+                                            chunk=128))
+            self.assertEqual([i for i, _ in res], list(range(len(self.regions))))
+            for (i, near), (chrom, start, end) in zip(res, self.regions):
+                self.assertEqual(set(f.name for f in near),
+                                 brute_nearest(feats, chrom, start, end, k))
+        # no transaction is left open with the database locked.
+        c = sqlite3.connect(self.path, timeout=0.1)
+        c.execute("CREATE TABLE other (a integer)")
+        c.commit()
+        c.close()
+
+    def test_rows(self):
+        from cruzdb.models import Record
+        for chrom, start, end in self.regions[:50]:
+            orm = self.g.bin_query("refGene", chrom, start, end).all()
+            raw = self.g.bin_query("refGene", chrom, start, end, raw=True)
+            self.assertEqual(sorted(f.name for f in raw),
+                             sorted(f.name for f in orm))
+            for r in raw:
+                self.assertTrue(isinstance(r, Record))
+                f = [o for o in orm if o.name == r.name][0]
+                self.assertEqual((r.start, r.end, r.exons, r.bed()),
+                                 (f.start, f.end, f.exons, f.bed()))
+                # only the slots for the columns.
+                self.assertFalse(hasattr(r, "__dict__"))
+                self.assertRaises(AttributeError, setattr, r, "other", 1)
+        q = self.g.refGene.filter_by(strand="-")
+        self.assertEqual(sorted(f.name for f in self.g.rows(q, "chr2")),
+            sorted(f.name for f in q.filter_by(chrom="chr2")))
+        self.assertEqual(len(self.g.rows("refGene")), self.g.refGene.count())
+
+    def test_cached_statements(self):
+        feats = self.g.refGene.all()
+        regions = self.regions[:60] + [("chr1", 0, 30000000)]
+        for i, (chrom, start, end) in enumerate(regions):
+            names = sorted(f.name for f in
+                           self.g.bin_query("refGene", chrom, start, end))
+            self.assertEqual(sorted(f.name for f in self.g.bin_query(
+                "refGene", chrom, start, end, raw=True)), names)
+            self.assertEqual(sorted(f.name for f in self.g._overlapping(
+                "refGene", chrom, start, end)), names)
+            k = (1, 3)[i % 2]
+            for table in ("refGene", self.g.refGene.filter_by(strand="+")):
+                res = self.g.knearest(table, chrom, start, end, k=k)
+                self.assertEqual(set(f.name for f in res), brute_nearest(
+                    [f for f in feats if table == "refGene" or
+                     f.strand == "+"], chrom, start, end, k))
+        # one statement with the bin filter and one without.
+        self.assertEqual(len(self.g._statements), 2)
+
+    def test_bin_ranges(self):
+        from cruzdb import _bin_ranges
+        for chrom, start, end in self.regions[:50]:
+            bins = set()
+            for first, last in _bin_ranges(start, end):
+                bins.update(range(first, last + 1))
+            self.assertEqual(bins, Genome.bins(start, end) | set([0]))
+
+        # a feature across a 64Mb boundary is in bin 0.
+        c = sqlite3.connect(self.path)
+        c.execute("""INSERT INTO refGene (bin, name, chrom, txStart, txEnd)
+                     VALUES (0, 'NM_wide', 'chr1', 67100000, 67200000)""")
+        c.commit()
+        c.close()
+        feats = self.g.refGene.all()
+        for chrom, start, end in self.regions[:20] + [("chr1", 67108000,
+                67108900), ("chr1", 0, 70000000), ("chr2", 1000, 30000000)]:
+            expected = sorted(f.name for f in feats if f.chrom == chrom
+                              and f.start <= end and f.end >= start)
+            q = self.g.bin_query("refGene", chrom, start, end)
+            self.assertEqual(sorted(f.name for f in q), expected)
+            self.assertEqual(sorted(f.name for f in self.g.bin_query(
+                "refGene", chrom, start, end, raw=True)), expected)
+            self.assertFalse(" IN " in str(q))
+        # wide queries bound the start by the longest feature instead.
+        self.assertTrue('"txStart" >=' in str(self.g.bin_query("refGene",
+                                                    "chr1", 0, 70000000)))
+        self.assertEqual(self.g._max_length(self.g.refGene._table, "chr1"),
+                         max(f.end - f.start for f in feats
+                             if f.chrom == "chr1"))
+
+    def test_columns(self):
+        feats = self.g.refGene.all()
+        self.g.session.expunge_all()
+        for i, (chrom, start, end) in enumerate(self.regions[:60]):
+            res = self.g.bin_query("refGene", chrom, start, end, columns=["name"])
+            self.assertEqual(set(f.name for f in res), set(f.name for f in
+                             self.g.bin_query("refGene", chrom, start, end,
+                                              raw=True)))
+            for f in res:
+                self.assertFalse("exonStarts" in f.__dict__)
+            raw = self.g.bin_query("refGene", chrom, start, end, raw=True,
+                                   columns=["name"])
+            for f in raw:
+                self.assertEqual(f._columns, ("name", "chrom", "txStart", "txEnd"))
+            self.assertEqual(set(f.name for f in self.g.knearest("refGene",
+                                 chrom, start, end, k=2, columns=["strand"])),
+                             brute_nearest(feats, chrom, start, end, 2))
+        self.assertEqual(len(list(self.g.stream("refGene", chunk=100,
+                                                columns=("name",)))), len(feats))
+        self.assertRaises(ValueError, self.g.bin_query, "refGene", "chr1", 0,
+                          10, columns=["nope"])
+
+        g = Genome("sqlite:///" + self.path, defer_blobs=True)
+        f = g.refGene.first()
+        self.assertFalse("exonStarts" in f.__dict__)
+        self.assertEqual(f.exons, [(f.start, f.end)])
+
+    def test_tile_cache(self):
+        c = Genome("sqlite:///" + self.path, tile_cache=500)
+        feats = self.g.refGene.all()
+        for i, (chrom, start, end) in enumerate(sorted(self.regions)):
+            k = (1, 2, 5)[i % 3]
+            self.assertEqual(
+                set(f.name for f in c.bin_query("refGene", chrom, start, end)),
+                set(f.name for f in self.g.bin_query("refGene", chrom, start, end)))
+            self.assertEqual(
+                set(f.name for f in c.knearest("refGene", chrom, start, end, k=k)),
+                brute_nearest(feats, chrom, start, end, k))
+        cache = c.tile_cache
+        self.assertTrue(cache.hits > cache.misses > 0)
+        self.assertTrue(cache.evictions > 0)
+        self.assertTrue(cache.rows <= 500)
+
+    def test_local_cache(self):
+        cache = self.path + ".cache.db"
+        feats = self.g.refGene.all()
+        regions = sorted(self.regions)[:100]
+        try:
+            for run in range(2):
+                c = Genome("sqlite:///" + self.path, cache="sqlite:///" + cache)
+                for chrom, start, end in regions:
+                    self.assertEqual(
+                        set(f.name for f in c.knearest("refGene", chrom, start, end, k=2)),
+                        brute_nearest(feats, chrom, start, end, 2))
+                local = c.tile_cache.backing
+                if run == 0:
+                    self.assertEqual(local.hits, 0)
+                    # the remote table is left as it was.
+                    self.assertEqual([i.name for i in c.refGene._table.indexes],
+                                     ["refGene_chrom_bin"])
+                else:
+                    self.assertEqual(local.misses, 0)
+                    self.assertTrue(local.hits > 0)
+            # rows in more than one tile are only saved once.
+            names = [r[0] for r in sqlite3.connect(cache).execute(
+                                        "SELECT name FROM refGene")]
+            self.assertEqual(len(names), len(set(names)))
+        finally:
+            os.unlink(cache)
+
+    def test_local_cache_tile_edge(self):
+        # a row that ends on the first base of a tile is only fetched with
+        # the tile before.
+        c = sqlite3.connect(self.path)
+        c.execute("""INSERT INTO refGene (bin, name, chrom, txStart, txEnd)
+                     VALUES (?, 'edge', 'chr3', ?, ?)""",
+                  (ucsc_bin(3 << 17, 4 << 17), 3 << 17, 4 << 17))
+        c.commit()
+        c.close()
+        cache = self.path + ".cache.db"
+        try:
+            c = Genome("sqlite:///" + self.path, cache="sqlite:///" + cache)
+            for t in (4, 3):
+                c.bin_query("refGene", "chr3", t << 17, t << 17).all()
+            names = [r[0] for r in sqlite3.connect(cache).execute(
+                                        "SELECT name FROM refGene")]
+            self.assertEqual(names, ["edge"])
+        finally:
+            os.unlink(cache)
+
+    def test_local_cache_grows(self):
+        # rows added to the local copy after its longest feature was read.
+        c = sqlite3.connect(self.path)
+        c.execute("""CREATE TABLE nobin (name varchar(255),
+                     chrom varchar(255), txStart integer, txEnd integer)""")
+        c.executemany("INSERT INTO nobin VALUES (?, 'chr1', ?, ?)", [
+            ("short", 10, 110), ("mid", 131082, 131182),
+            ("long", 5250000, 5550000), ("short2", 5500000, 5500100)])
+        c.commit()
+        c.close()
+        cache = self.path + ".cache.db"
+        try:
+            c = Genome("sqlite:///" + self.path, cache="sqlite:///" + cache,
+                       tile_cache=1)
+            for start in (0, 131072, 0, 5250000, 5500000, 0, 5500000):
+                names = sorted(f.name for f in c.bin_query("nobin", "chr1",
+                                                      start, start + 50))
+            self.assertEqual(names, ["long", "short2"])
+        finally:
+            os.unlink(cache)
+
+    def test_stream(self):
+        c = sqlite3.connect(self.path)
+        c.execute("""INSERT INTO refGene (name, chrom, txStart, txEnd)
+                     VALUES ('no_bin', 'chr1', 5, 10)""")
+        c.commit()
+        c.close()
+        names = sorted(f.name for f in self.g.refGene.all())
+        # (chrom, bin) isn't unique so pages end part way through a key.
+        for chunk in (1, 7, 8000):
+            self.assertEqual(sorted(f.name for f in
+                             self.g.stream("refGene", chunk=chunk)), names)
+
+    def test_mirror(self):
+        import cruzdb.mirror
+        dest = self.path + ".mirror.db"
+        rows = cruzdb.mirror.PARTITION_ROWS
+        try:
+            cruzdb.mirror.PARTITION_ROWS = 100
+            m = self.g.mirror(["refGene"], "sqlite:///" + dest, threads=2)
+            self.assertEqual(m.refGene.count(), self.g.refGene.count())
+            # an interrupted copy of chr2.
+            c = sqlite3.connect(dest)
+            self.assertEqual(sorted(r for r in c.execute(
+                "SELECT part, verified FROM cruzdb_mirror")),
+                [("chr1", 1), ("chr2", 1)])
+            # the indexes are built after the rows are loaded.
+            self.assertEqual([r[0] for r in c.execute("""SELECT sql FROM
+                sqlite_master WHERE type = 'index'""")],
+                ['CREATE INDEX "refGene.refGene_chrom_bin_ix0" ON "refGene" (chrom, bin)'])
+            c.execute("DELETE FROM cruzdb_mirror WHERE part = 'chr2'")
+            c.execute("DELETE FROM refGene WHERE chrom = 'chr2' AND txStart > 100")
+            c.commit()
+            c.close()
+            m = self.g.mirror(["refGene"], "sqlite:///" + dest)
+            self.assertEqual(sorted(f.name for f in m.refGene),
+                             sorted(f.name for f in self.g.refGene))
+        finally:
+            cruzdb.mirror.PARTITION_ROWS = rows
+            os.unlink(dest)
+
+    def test_mirror_regions(self):
+        c = sqlite3.connect(self.path)
+        c.execute("CREATE TABLE chromInfo (chrom varchar(255), size integer)")
+        c.executemany("INSERT INTO chromInfo VALUES (?, ?)", [("chr1", 5000000),
+                      ("chr2", 5000000), ("chr3", 5000000)])
+        c.execute("CREATE TABLE refLink (name varchar(255), mrnaAcc varchar(255))")
+        c.execute("INSERT INTO refLink SELECT name2, name FROM refGene")
+        c.commit()
+        c.close()
+        dest = self.path + ".regions.db"
+        try:
+            m = self.g.mirror(["refGene"], "sqlite:///" + dest,
+                              regions=["chr2", ("chr1", 0, 1000000)])
+            names = sorted(f.name for f in self.g.refGene if f.chrom == "chr2"
+                           or (f.chrom == "chr1" and f.txStart <= 1000000))
+            self.assertEqual(sorted(f.name for f in m.refGene), names)
+            self.assertEqual(sorted(f.chrom for f in m.chromInfo),
+                             ["chr1", "chr2"])
+            self.assertEqual(sorted(f.mrnaAcc for f in m.refLink), names)
+            # only the tables that were added may be missing.
+            from sqlalchemy.exc import NoSuchTableError
+            self.assertRaises(NoSuchTableError, self.g.mirror, ["refGen"],
+                              "sqlite:///" + dest, regions=["chr2"])
+        finally:
+            os.unlink(dest)
+
+    def test_stats(self):
+        from cruzdb.stats import TableStats
+        feats = self.g.refGene.all()
+        st = self.g.stats("refGene")
+        self.assertEqual(st.count, len(feats))
+        for chrom in ("chr1", "chr2"):
+            on = [f for f in feats if f.chrom == chrom]
+            self.assertEqual(st.rows[chrom], len(on))
+            self.assertEqual(st.max_length[chrom], max(f.end - f.start for f in on))
+            self.assertEqual(st.span[chrom], max(f.end for f in on))
+        self.assertEqual(sum(st.lengths), len(feats))
+        self.assertEqual(st.lengths[3], sum(1 for f in feats
+                                            if 1000 <= f.end - f.start < 10000))
+        self.assertEqual(sum(st.bins.values()), len(feats))
+        self.assertEqual(st.bins[585], sum(1 for f in feats if f.bin == 585))
+        self.assertTrue(st.has_index("chrom", "bin"))
+        self.assertFalse(st.has_index("chrom", "txStart"))
+        self.assertTrue(self.g.stats("refGene") is st)
+        self.assertEqual(TableStats.from_json(st.to_json()).to_json(),
+                         st.to_json())
+
+        # the queries are planned with the stats.
+        for i, (chrom, start, end) in enumerate(self.regions[:60] +
+                [("chr1", 0, 20000000), ("chr2", 3990000, 4000000)]):
+            self.assertEqual(sorted(f.name for f in self.g.bin_query(
+                             "refGene", chrom, start, end, raw=True)),
+                             sorted(f.name for f in feats if f.chrom == chrom
+                                    and f.start <= end and f.end >= start))
+            k = (1, 2, 5)[i % 3]
+            self.assertEqual(set(f.name for f in self.g.knearest("refGene",
+                                 chrom, start, end, k=k)),
+                             brute_nearest(feats, chrom, start, end, k))
+        self.assertTrue(self.g._window_nearest("refGene", "chr1", 1000,
+                                               1010, 3, None) is not None)
+
+        # a mirror keeps the stats of its tables.
+        dest = self.path + ".stats.db"
+        try:
+            self.g.mirror(["refGene"], "sqlite:///" + dest)
+            m = Genome("sqlite:///" + dest)
+            self.assertEqual(m._known_stats(m.refGene._table).rows, st.rows)
+            # but they only choose the plan; rows added since aren't missed.
+            c = sqlite3.connect(dest)
+            c.execute("""INSERT INTO refGene (bin, name, chrom, txStart, txEnd)
+                         VALUES (?, 'long', 'chr1', 0, 8000000)""",
+                      (ucsc_bin(0, 8000000),))
+            c.commit()
+            c.close()
+            m = Genome("sqlite:///" + dest)
+            tbl = m.refGene._table
+            self.assertEqual(m._max_length(tbl, "chr1"), 8000000)
+            for start in (10000, 3000000, 7990000):
+                ranges, lowest = m._plan(tbl, "chr1", start, start + 10)
+                self.assertTrue(lowest is None or lowest <= 0)
+                self.assertTrue("long" in [f.name for f in
+                                m.bin_query("refGene", "chr1", start, start + 10)])
+        finally:
+            os.unlink(dest)
+
+    def test_bins_array(self):
+        random.seed(3)
+        starts = [random.randint(0, 200000000) for i in range(5000)]
+        ends = [s + random.randint(1, 10 ** random.randint(1, 8)) for s in starts]
+        self.assertEqual(Genome.bins_array(starts, ends).tolist(),
+                         [ucsc_bin(s, e) for s, e in zip(starts, ends)])
+
+    def test_load_file(self):
+        bed = self.path + ".bed"
+        with open(bed, "w") as fh:
+            fh.write("chrom\tstart\tend\tscore\n")
+            for i, (chrom, start, end) in enumerate(self.regions):
+                fh.write("%s\t%i\t%i\t%s\n" % (chrom, start, end,
+                                               "" if i % 3 else "%i.5" % i))
+        c = sqlite3.connect(self.path)
+        c.execute("PRAGMA journal_mode = WAL")
+        c.close()
+        try:
+            self.g.load_file(bed, table="peaks", bins=True)
+            # the database's own settings are kept.
+            c = sqlite3.connect(self.path)
+            self.assertEqual(c.execute("PRAGMA journal_mode").fetchall(),
+                             [("wal",)])
+            c.close()
+            g = Genome("sqlite:///" + self.path)
+            rows = g.sql("SELECT chrom, txStart, txEnd, bin, name, score "
+                         "FROM peaks").fetchall()
+            self.assertEqual([r[:3] for r in rows], self.regions)
+            self.assertEqual([r[3] for r in rows],
+                             [ucsc_bin(s, e) for c, s, e in self.regions])
+            self.assertEqual(rows[0][4], "%s:%i" % self.regions[0][:2])
+            self.assertEqual([r[5] for r in rows[:2]], [0.5, None])
+        finally:
+            os.unlink(bed)
+
+    def test_columnar(self):
+        import shutil
+        path = tempfile.mkdtemp()
+        try:
+            c = self.g.mirror(["refGene"], "columnar://" + path)
+            feats = self.g.refGene.all()
+            for i, (chrom, start, end) in enumerate(self.regions):
+                k = (1, 2, 5)[i % 3]
+                self.assertEqual(
+                    set(f.name for f in c.bin_query("refGene", chrom, start, end)),
+                    set(f.name for f in self.g.bin_query("refGene", chrom, start, end)))
+                self.assertEqual(
+                    set(f.name for f in c.knearest("refGene", chrom, start, end, k=k)),
+                    brute_nearest(feats, chrom, start, end, k))
+            df = c.dataframe("refGene")
+            self.assertEqual(sorted(df.name), sorted(f.name for f in feats))
+            self.assertEqual(list(df.columns), list(self.g.dataframe("refGene").columns))
+            f = c.refGene.rows("chr1", [0])[0]
+            self.assertEqual(f.exons, [(f.start, f.end)])
+        finally:
+            shutil.rmtree(path)
+
+    def test_load_ucsc_dump(self):
+        import gzip
+        import cruzdb.mirror
+        schema, data = self.path + ".sql", self.path + ".txt.gz"
+        dest = self.path + ".dump.db"
+        with open(schema, "w") as fh:
+            fh.write("""DROP TABLE IF EXISTS `refGene`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+CREATE TABLE `refGene` (
+  `bin` smallint(5) unsigned NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `chrom` varchar(255) NOT NULL,
+  `strand` char(1) NOT NULL,
+  `txStart` int(10) unsigned NOT NULL,
+  `txEnd` int(10) unsigned NOT NULL,
+  `cdsStartStat` enum('none','unk','incmpl','cmpl') NOT NULL,
+  `exonStarts` longblob NOT NULL,
+  `score` double default NULL,
+  KEY `chrom` (`chrom`,`bin`),
+  KEY `name` (`name`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+""")
+        feats = self.g.refGene.all()
+        with gzip.open(data, "wb") as fh:
+            for i, f in enumerate(feats):
+                fh.write(("%i\t%s\t%s\t%s\t%i\t%i\tcmpl\t%s\t%s\n" % (f.bin,
+                    f.name, f.chrom, f.strand, f.txStart, f.txEnd,
+                    # a literal TAB or LF in a field is escaped.
+                    "a\\tb" if i == 0 else f.exonStarts.decode() + "\\\t\\\n",
+                    "\\N" if i % 2 else "%i.5" % i)).encode())
+        block = cruzdb.mirror.DUMP_BLOCK
+        cruzdb.mirror.DUMP_BLOCK = 1000
+        try:
+            for run in range(2):
+                m = self.g.load_ucsc_dump(schema, data, "sqlite:///" + dest,
+                                          processes=2)
+            rows = m.refGene.order_by(m.refGene.txStart).all()
+            self.assertEqual([(r.name, r.txStart, r.txEnd) for r in rows],
+                             sorted(((f.name, f.txStart, f.txEnd) for f in feats),
+                                    key=lambda r: r[1]))
+            first = m.refGene.filter_by(name=feats[0].name).one()
+            self.assertEqual(first.exonStarts, "a\tb")
+            self.assertEqual(m.refGene.filter_by(name=feats[1].name).one(
+                ).exonStarts, feats[1].exonStarts.decode() + "\t\n")
+            self.assertEqual(first.score, 0.5)
+            self.assertEqual(m.refGene.filter_by(name=feats[1].name).one().score,
+                             None)
+            chrom, start, end = self.regions[0]
+            self.assertEqual(
+                set(f.name for f in m.bin_query("refGene", chrom, start, end)),
+                set(f.name for f in self.g.bin_query("refGene", chrom, start, end)))
+        finally:
+            cruzdb.mirror.DUMP_BLOCK = block
+            for f in (schema, data, dest):
+                os.unlink(f)
+
+    def test_up_down_stream(self):
+        f = self.g.refGene.filter_by(strand="-").first()
+        for u in self.g.upstream("refGene", f, k=4):
+            self.assertTrue(u.end > f.start)
+        for d in self.g.downstream("refGene", f, k=4):
+            self.assertTrue(d.start < f.end)
+        self.assertTrue(len(self.g.upstream("refGene", f, k=4)) >= 4)
+
+    def test_sweep(self):
+        from cruzdb.intersecter import Intersecter, Feature
+        from cruzdb.sweep import closest
+        feats = self.g.refGene.all()
+        queries = sorted((Feature(s, e, chrom=c) for c, s, e in self.regions),
+                         key=lambda q: (q.chrom, q.start))
+        # out of order queries are still answered.
+        queries.append(Feature(100, 200, chrom="chr1"))
+        for src in ("refGene", Intersecter(feats)):
+            for q, res in closest(queries, src, k=2, genome=self.g):
+                self.assertEqual(set(f.name for f in res),
+                        brute_nearest(feats, q.chrom, q.start, q.end, 2))
+
+    def test_build_index(self):
+        from cruzdb.intersecter import Intersecter
+        path = self.path + ".idx"
+        self.g.build_index("refGene", path)
+        try:
+            idx = Intersecter.open(path)
+            feats = self.g.refGene.all()
+            self.assertEqual(len(idx), len(feats))
+            for chrom, start, end in self.regions:
+                self.assertEqual(
+                    set(f.name for f in idx.knearest(start, end, chrom, k=2)),
+                    brute_nearest(feats, chrom, start, end, 2))
+            f = idx.find(feats[0].start, feats[0].end, feats[0].chrom)[0]
+            self.assertEqual(f.exons, [(f.start, f.end)])
+        finally:
+            del idx
+            os.unlink(path)
+
+    def test_annotate_parallel(self):
+        from six import StringIO
+        import cruzdb.annotate
+        bed = self.path + ".bed"
+        with open(bed, "w") as fh:
+            fh.write("#chrom\tstart\tend\n")
+            for r in sorted(self.regions):
+                fh.write("%s\t%i\t%i\n" % r)
+        block = cruzdb.annotate.PARALLEL_BLOCK
+        cruzdb.annotate.PARALLEL_BLOCK = 37
+        try:
+            serial, par = StringIO(), StringIO()
+            self.g.annotate(bed, ["refGene"], out=serial, in_memory=False)
+            self.g.annotate(bed, ["refGene"], out=par, parallel=True,
+                            in_memory=True, sweep=True)
+        finally:
+            cruzdb.annotate.PARALLEL_BLOCK = block
+            os.unlink(bed)
+        # ties may be listed in a different order.
+        norm = lambda s: [[sorted(t.split(";")) for t in l.split("\t")]
+                           for l in s.getvalue().split("\n")]
+        self.assertEqual(norm(serial), norm(par))
+        self.assertTrue(par.getvalue().startswith("#chrom\tstart\tend\t"))
+
+    def test_plan(self):
+        from cruzdb.annotate import plan
+        sample = [["chr1", str(s), str(s + 10)] for s in range(0, 5000, 100)]
+        self.assertEqual(plan(self.g, ["refGene"], sample[:1]), ["sql"])
+        self.assertEqual(plan(self.g, ["refGene"], sample, 10 ** 6),
+                         ["memory-sweep"])
+        self.assertEqual(plan(self.g, ["refGene"], sample[::-1], 10 ** 6),
+                         ["memory"])
+
+    def tearDown(self):
+        self.g.session.close()
+        os.unlink(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+compare the max_len search in Intersecter to the nested containment list
+on intervals that include a few very long outliers (e.g. a huge lincRNA or
+a dgv CNV spanning megabases).
+"""
+from __future__ import print_function
+import sys
+sys.path.extend([".", "scripts", "cruzdb"])
+import random
+from intersecter import Intersecter, Feature
+import time
+
+
+N = 200000
+OUTLIERS = 5
+TRIES = 2000
+STOP = 50000000
+
+def rands(n=N, len_range=(200, 16000), start_max=STOP):
+
+    def rand():
+        start = random.randint(1, start_max)
+        return Feature(start, start + random.randint(*len_range), chrom="chr1")
+
+    return [rand() for i in range(n)]
+
+
+def search(tree, queries):
+    t0 = time.time()
+    lens = []
+    for start, end in queries:
+        res = tree.find(start, end, chrom="chr1")
+        lens.append(sorted((x.start, x.end) for x in res))
+    t1 = time.time()
+    return t1 - t0, lens
+
+
+random.seed(42)
+intervals = rands(N)
+queries = [(s, s + random.randint(1, 5000)) for s in
+                random.sample(range(STOP), TRIES)]
+
+for outliers in (0, OUTLIERS):
+    intervals.extend(rands(outliers, len_range=(STOP // 4, STOP // 2),
+                           start_max=STOP // 2))
+    longest = max(i.end - i.start for i in intervals)
+
+    t0 = time.time()
+    ints = Intersecter(intervals)
+    t1 = time.time()
+    print("time to build Intersecter with %i intervals: %.3f" % (len(intervals), t1 - t0))
+    t0 = time.time()
+    ncl = Intersecter(intervals, index="nclist")
+    t1 = time.time()
+    print("time to build NCList with %i intervals: %.3f" % (len(intervals), t1 - t0))
+
+    t, inter_lens = search(ints, queries)
+    print("max_len %i: time to search intersecter %i times: %.3f" % (longest, TRIES, t))
+    t, ncl_lens = search(ncl, queries)
+    print("max_len %i: time to search nclist %i times: %.3f" % (longest, TRIES, t))
+
+    assert inter_lens == ncl_lens
+    print()